@@ -4,18 +4,21 @@ Code mode API router
 - Project/file management
 - SSE streaming
 """
-from fastapi import APIRouter, Form
-from fastapi.responses import HTMLResponse, JSONResponse
-import re
+from fastapi import APIRouter, Form, Request
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
+import asyncio
+import os
+import shutil
+import time
 
 from app import db
-from app.config import WORKSPACE_DIR, run_local_command
+from app.config import WORKSPACE_DIR
 from app.shared import (
-    mode_chat_handler, mode_stream_sse,
+    PROJECT_NAME_RE, BoundedResponses, mode_chat_handler, mode_stream_sse,
     mode_status_response, mode_active_response, mode_file_content, mode_file_write,
     make_file_raw_response, make_file_download_response,
     mode_delete_file, mode_create_file, mode_create_folder, mode_list_directories,
-    render_file_tree_html,
+    make_file_tree_response, project_locks,
     mode_clear_session, mode_context_percent, mode_messages_html
 )
 
@@ -26,20 +29,71 @@ get_session_lock = None
 
 # Shared state (accessed from main.py)
 active_streams = {}  # {response_id: {"cancelled": bool, "process": subprocess or None}}
-code_responses = {}  # {response_id: {"project", "status", "events", ...}}
+code_responses = BoundedResponses()  # {response_id: {"project", "status", "events", ...}}
+
+# Directories skipped by the file explorer walk
+CODE_PRUNE_DIRS = frozenset({'venv', '__pycache__', 'node_modules', '.git'})
+
+# Short-TTL caches for sidebar/explorer polling (cleared by project mutations)
+PROJECTS_CACHE_TTL = 1.0
+LIST_DIRS_CACHE_TTL = 2.0
+_projects_cache = {"ts": 0.0, "val": None}
+_list_dirs_cache = {}  # {project: (ts, dirs)}
+
+
+def invalidate_caches(project: str = None):
+    """Drop cached project listings (all list-dirs entries if project is None)"""
+    _projects_cache["ts"] = 0.0
+    if project is None:
+        _list_dirs_cache.clear()
+    else:
+        _list_dirs_cache.pop(project, None)
 
 
 # ========== Project Management ==========
 
+_WORKSPACE_REAL = os.path.realpath(WORKSPACE_DIR)
+
+
+def _safe_project_dir(project: str, check_name: bool = True):
+    """Workspace path for a project, or None if the name is invalid or resolves outside WORKSPACE_DIR.
+    check_name=False skips the name pattern (existing projects may predate it) but still rejects traversal"""
+    if not project or os.sep in project or project in (".", ".."):
+        return None
+    if check_name and not PROJECT_NAME_RE.match(project):
+        return None
+    path = os.path.join(WORKSPACE_DIR, project)
+    if not os.path.realpath(path).startswith(_WORKSPACE_REAL + os.sep):
+        return None
+    return path
+
+
+def _list_workspace() -> list:
+    """List project directories in the workspace (cached for PROJECTS_CACHE_TTL)"""
+    now = time.monotonic()
+    if _projects_cache["val"] is not None and now - _projects_cache["ts"] < PROJECTS_CACHE_TTL:
+        return _projects_cache["val"]
+    try:
+        with os.scandir(WORKSPACE_DIR) as it:
+            entries = sorted(e.name for e in it if e.is_dir(follow_symlinks=False) and not e.name.startswith('.'))
+    except FileNotFoundError:
+        entries = []
+    _projects_cache.update(ts=now, val=entries)
+    return entries
+
+
 @router.post("/code/new-project")
 async def create_new_project(project_name: str = Form(...)):
     """Create a new project folder"""
-    if not re.match(r'^[a-zA-Z0-9_-]+$', project_name):
+    project_dir = _safe_project_dir(project_name)
+    if not project_dir:
         return JSONResponse({"error": "Project name can only contain letters, numbers, hyphens, and underscores."}, status_code=400)
-    success, output = run_local_command(f"mkdir -p {WORKSPACE_DIR}/{project_name} && echo 'created'")
-    if success:
-        return JSONResponse({"success": True, "project": project_name})
-    return JSONResponse({"error": f"Folder creation failed: {output}"}, status_code=500)
+    try:
+        await asyncio.to_thread(os.makedirs, project_dir, exist_ok=True)
+    except OSError as e:
+        return JSONResponse({"error": f"Folder creation failed: {e}"}, status_code=500)
+    invalidate_caches(project_name)
+    return JSONResponse({"success": True, "project": project_name})
 
 
 @router.post("/code/clone")
@@ -47,20 +101,24 @@ async def clone_project(source: str = Form(""), target: str = Form("")):
     """Clone a project (copy files, new session)"""
     if not source or not target:
         return JSONResponse({"error": "Source and target project names are required."}, status_code=400)
-    if not re.match(r'^[a-zA-Z0-9_-]+$', target):
+    dst = _safe_project_dir(target)
+    if not dst:
         return JSONResponse({"error": "Project name can only contain letters, numbers, hyphens, and underscores."}, status_code=400)
-    # Check source exists
-    success, output = run_local_command(f"test -d {WORKSPACE_DIR}/{source} && echo 'exists'")
-    if not success or 'exists' not in output:
-        return JSONResponse({"error": f"Source project '{source}' not found."}, status_code=404)
-    # Check target does not already exist
-    success, output = run_local_command(f"test -d {WORKSPACE_DIR}/{target} && echo 'exists'")
-    if success and 'exists' in output:
-        return JSONResponse({"error": f"Project '{target}' already exists."}, status_code=409)
-    # Copy
-    success, output = run_local_command(f"cp -r {WORKSPACE_DIR}/{source} {WORKSPACE_DIR}/{target}")
-    if not success:
-        return JSONResponse({"error": f"Clone failed: {output}"}, status_code=500)
+    src = _safe_project_dir(source, check_name=False)
+    async with project_locks("code", source, target):
+        # Check source exists
+        if not src or not os.path.isdir(src):
+            return JSONResponse({"error": f"Source project '{source}' not found."}, status_code=404)
+        # Check target does not already exist (any entry, including files and dangling symlinks)
+        if os.path.lexists(dst):
+            return JSONResponse({"error": f"Project '{target}' already exists."}, status_code=409)
+        # Copy
+        try:
+            await asyncio.to_thread(shutil.copytree, src, dst, symlinks=True)
+        except OSError as e:
+            return JSONResponse({"error": f"Clone failed: {e}"}, status_code=500)
+        finally:
+            invalidate_caches(target)
     return JSONResponse({"success": True, "project": target})
 
 
@@ -69,22 +127,26 @@ async def rename_project(old_name: str = Form(""), new_name: str = Form("")):
     """Rename a project (mv + delete existing DB session)"""
     if not old_name or not new_name:
         return JSONResponse({"error": "Old name and new name are required."}, status_code=400)
-    if not re.match(r'^[a-zA-Z0-9_-]+$', new_name):
+    dst = _safe_project_dir(new_name)
+    if not dst:
         return JSONResponse({"error": "Project name can only contain letters, numbers, hyphens, and underscores."}, status_code=400)
-    # Check source exists
-    success, output = run_local_command(f"test -d {WORKSPACE_DIR}/{old_name} && echo 'exists'")
-    if not success or 'exists' not in output:
-        return JSONResponse({"error": f"Project '{old_name}' not found."}, status_code=404)
-    # Check target does not already exist
-    success, output = run_local_command(f"test -d {WORKSPACE_DIR}/{new_name} && echo 'exists'")
-    if success and 'exists' in output:
-        return JSONResponse({"error": f"Project '{new_name}' already exists."}, status_code=409)
-    # Rename
-    success, output = run_local_command(f"mv {WORKSPACE_DIR}/{old_name} {WORKSPACE_DIR}/{new_name}")
-    if not success:
-        return JSONResponse({"error": f"Rename failed: {output}"}, status_code=500)
-    # Delete existing DB session (reset conversation)
-    db.delete_mode_project("code", old_name)
+    src = _safe_project_dir(old_name, check_name=False)
+    async with project_locks("code", old_name, new_name):
+        # Check source exists
+        if not src or not os.path.isdir(src):
+            return JSONResponse({"error": f"Project '{old_name}' not found."}, status_code=404)
+        # Check target does not already exist (any entry, including files and dangling symlinks)
+        if os.path.lexists(dst):
+            return JSONResponse({"error": f"Project '{new_name}' already exists."}, status_code=409)
+        # Rename
+        try:
+            await asyncio.to_thread(os.rename, src, dst)
+        except OSError as e:
+            return JSONResponse({"error": f"Rename failed: {e}"}, status_code=500)
+        invalidate_caches(old_name)
+        invalidate_caches(new_name)
+        # Delete existing DB session (reset conversation)
+        await asyncio.to_thread(db.delete_mode_project, "code", old_name)
     return JSONResponse({"success": True, "project": new_name})
 
 
@@ -93,86 +155,111 @@ async def delete_project(project: str = ""):
     """Delete a project (folder + DB)"""
     if not project:
         return JSONResponse({"error": "Project name is required."}, status_code=400)
-    if not re.match(r'^[a-zA-Z0-9_-]+$', project):
+    project_dir = _safe_project_dir(project)
+    if not project_dir:
         return JSONResponse({"error": "Invalid project name."}, status_code=400)
-    success, output = run_local_command(f"rm -rf {WORKSPACE_DIR}/{project}")
-    if not success:
-        return JSONResponse({"error": f"Folder deletion failed: {output}"}, status_code=500)
-    db.delete_mode_project("code", project)
+    async with project_locks("code", project):
+        try:
+            await asyncio.to_thread(shutil.rmtree, project_dir)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            return JSONResponse({"error": f"Folder deletion failed: {e}"}, status_code=500)
+        finally:
+            invalidate_caches(project)
+        await asyncio.to_thread(db.delete_mode_project, "code", project)
     return JSONResponse({"success": True, "message": f"Project '{project}' has been deleted."})
 
 
 @router.delete("/code/file")
 async def delete_file(project: str = "", path: str = ""):
     """Delete a file"""
-    result, status_code = mode_delete_file(WORKSPACE_DIR, project, path)
+    result, status_code = await asyncio.to_thread(mode_delete_file, WORKSPACE_DIR, project, path)
+    _list_dirs_cache.pop(project, None)
     return JSONResponse(result, status_code=status_code)
 
 
 @router.post("/code/create-file")
 async def create_file(project: str = Form(""), path: str = Form(""), filename: str = Form("")):
     """Create a file within the project"""
-    result, status_code = mode_create_file(WORKSPACE_DIR, project, path, filename)
+    result, status_code = await asyncio.to_thread(mode_create_file, WORKSPACE_DIR, project, path, filename)
     return JSONResponse(result, status_code=status_code)
 
 
 @router.post("/code/create-folder")
 async def create_folder(project: str = Form(""), path: str = Form(""), foldername: str = Form("")):
     """Create a folder within the project"""
-    result, status_code = mode_create_folder(WORKSPACE_DIR, project, path, foldername)
+    result, status_code = await asyncio.to_thread(mode_create_folder, WORKSPACE_DIR, project, path, foldername)
+    _list_dirs_cache.pop(project, None)
     return JSONResponse(result, status_code=status_code)
 
 
 @router.get("/code/list-dirs")
 async def list_dirs(project: str = ""):
     """List directories within the project"""
-    find_extra = "\\( -name 'venv' -o -name '__pycache__' -o -name 'node_modules' -o -name '.git' \\) -prune -o "
-    dirs = mode_list_directories(WORKSPACE_DIR, project, find_extra)
-    return JSONResponse(dirs)
+    if project and not _safe_project_dir(project, check_name=False):
+        return JSONResponse({"error": "Invalid project name."}, status_code=400)
+    cached = _list_dirs_cache.get(project)
+    if cached and time.monotonic() - cached[0] < LIST_DIRS_CACHE_TTL:
+        return ORJSONResponse(cached[1])
+    dirs = await asyncio.to_thread(mode_list_directories, WORKSPACE_DIR, project, CODE_PRUNE_DIRS)
+    _list_dirs_cache[project] = (time.monotonic(), dirs)
+    return ORJSONResponse(dirs)
 
 
 @router.get("/code/projects-json")
 async def get_projects_json():
     """List projects (excluding archived)"""
-    success, output = run_local_command(f"mkdir -p {WORKSPACE_DIR} && ls -1 {WORKSPACE_DIR} 2>/dev/null")
-    if not success:
+    try:
+        entries = await asyncio.to_thread(_list_workspace)
+    except OSError:
         return JSONResponse([])
-    archived = set(db.get_archived_projects("code"))
-    projects = [p.strip() for p in output.split('\n') if p.strip() and p.strip() not in archived]
-    return JSONResponse(projects)
+    archived = set(await asyncio.to_thread(db.get_archived_projects, "code"))
+    projects = [p for p in entries if p not in archived]
+    return ORJSONResponse(projects)
 
 
 # ========== File Explorer ==========
 
 @router.get("/code/files", response_class=HTMLResponse)
-async def get_files(project: str = ""):
-    """Get project directory structure"""
-    find_extra = "\\( -name 'venv' -o -name '__pycache__' -o -name 'node_modules' -o -name '.git' \\) -prune -o "
-    return HTMLResponse(render_file_tree_html(WORKSPACE_DIR, project, "code", find_extra))
+async def get_files(request: Request, project: str = ""):
+    """Get project directory structure (304 if unchanged since the client's ETag)"""
+    if project and not _safe_project_dir(project, check_name=False):
+        return HTMLResponse('<div class="text-red-500 text-xs">Invalid project name.</div>')
+    return await asyncio.to_thread(make_file_tree_response, WORKSPACE_DIR, project, "code", CODE_PRUNE_DIRS,
+                                   if_none_match=request.headers.get("if-none-match"))
 
 
 @router.get("/code/file-content")
 async def get_file_content(project: str = "", path: str = ""):
     """Get file content"""
-    return JSONResponse(mode_file_content(WORKSPACE_DIR, project, path))
+    if project and not _safe_project_dir(project, check_name=False):
+        return JSONResponse({"error": "Invalid project name."}, status_code=400)
+    return ORJSONResponse(await asyncio.to_thread(mode_file_content, WORKSPACE_DIR, project, path))
 
 
 @router.get("/code/file-raw")
-async def get_file_raw(project: str = "", path: str = ""):
+async def get_file_raw(request: Request, project: str = "", path: str = ""):
     """Get media file binary (images/videos)"""
-    return make_file_raw_response(WORKSPACE_DIR, project, path)
+    if project and not _safe_project_dir(project, check_name=False):
+        return JSONResponse({"error": "Invalid project name."}, status_code=400)
+    return await asyncio.to_thread(make_file_raw_response, WORKSPACE_DIR, project, path, request.headers.get("if-none-match"))
 
 
 @router.post("/code/file-write")
 async def write_file(project: str = Form(""), path: str = Form(""), content: str = Form("")):
     """Save file content"""
-    return JSONResponse(mode_file_write(WORKSPACE_DIR, project, path, content))
+    if project and not _safe_project_dir(project, check_name=False):
+        return JSONResponse({"error": "Invalid project name."}, status_code=400)
+    return JSONResponse(await asyncio.to_thread(mode_file_write, WORKSPACE_DIR, project, path, content))
 
 
 @router.get("/code/file-download")
-async def download_file(project: str = "", path: str = ""):
+async def download_file(request: Request, project: str = "", path: str = ""):
     """Download a file"""
-    return make_file_download_response(WORKSPACE_DIR, project, path)
+    if project and not _safe_project_dir(project, check_name=False):
+        return JSONResponse({"error": "Invalid project name."}, status_code=400)
+    return await asyncio.to_thread(make_file_download_response, WORKSPACE_DIR, project, path, request.headers.get("if-none-match"))
 
 
 # ========== Code Mode Chat ==========
@@ -180,7 +267,7 @@ async def download_file(project: str = "", path: str = ""):
 @router.post("/code", response_class=HTMLResponse)
 async def code_chat(project: str = Form(""), message: str = Form(""), mcp_tools: str = Form(""), file_map: str = Form(""), model: str = Form("sonnet")):
     """Send a message to Claude Code CLI"""
-    return HTMLResponse(mode_chat_handler(
+    return HTMLResponse(await mode_chat_handler(
         "code", project, message, mcp_tools, file_map,
         WORKSPACE_DIR, code_responses, active_streams, get_session_lock,
         "project and message", "Running Claude Code...", model=model
@@ -188,21 +275,21 @@ async def code_chat(project: str = Form(""), message: str = Form(""), mcp_tools:
 
 
 @router.get("/code/stream")
-async def code_stream(id: str = "", start_from: int = 0):
+async def code_stream(request: Request, id: str = "", start_from: int = 0):
     """Stream Claude Code CLI output via SSE"""
-    return await mode_stream_sse(id, code_responses, active_streams, start_from)
+    return await mode_stream_sse(id, code_responses, active_streams, start_from, request=request)
 
 
 @router.get("/code/status/{response_id}")
 async def get_code_status(response_id: str):
     """Get status of an in-progress code response"""
-    return JSONResponse(mode_status_response(response_id, code_responses, "project"))
+    return ORJSONResponse(mode_status_response(response_id, code_responses, "project"))
 
 
 @router.get("/code/active")
 async def get_active_codes(project: str = ""):
     """Get list of active response IDs for a project"""
-    return JSONResponse(mode_active_response(code_responses, "project", project))
+    return ORJSONResponse(mode_active_response(code_responses, "project", project))
 
 
 # ========== Session Management ==========
@@ -210,7 +297,7 @@ async def get_active_codes(project: str = ""):
 @router.post("/code/clear")
 async def clear_code_session_endpoint(project: str = Form("")):
     """Clear code mode session"""
-    result = mode_clear_session("code", project, "Project")
+    result = await asyncio.to_thread(mode_clear_session, "code", project, "Project")
     if result:
         return JSONResponse(result)
     return JSONResponse({"error": "Project is required."}, status_code=400)
@@ -219,10 +306,10 @@ async def clear_code_session_endpoint(project: str = Form("")):
 @router.get("/code/context")
 async def get_context_percent(project: str = ""):
     """Get context percent for the project"""
-    return JSONResponse(mode_context_percent("code", project))
+    return JSONResponse(await asyncio.to_thread(mode_context_percent, "code", project))
 
 
 @router.get("/code/messages", response_class=HTMLResponse)
 async def get_code_messages(project: str = ""):
     """Get code messages HTML for the project"""
-    return HTMLResponse(mode_messages_html("code", project, WORKSPACE_DIR))
+    return HTMLResponse(await asyncio.to_thread(mode_messages_html, "code", project, WORKSPACE_DIR))
@@ -4,7 +4,7 @@ Ddoli configuration file
 - Uses default values when running locally
 """
 import os
-import subprocess
+from types import MappingProxyType
 
 # ========================
 # Working directories (local paths inside the container)
@@ -23,41 +23,35 @@ DB_PORT = int(os.environ.get("DB_PORT", "5432"))
 DB_NAME = os.environ.get("DB_NAME", "ddoli")
 DB_USER = os.environ.get("DB_USER", "ddoli")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "ddoli2026")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "4"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "16"))
 
 # ========================
 # MCP servers (defaults — used when no values are stored in DB)
 # ========================
-DEFAULT_MCP_SERVERS = {
+_DEFAULT_MCP_SERVERS = {
     "legal_mcp": {
         "type": "sse",
         "url": "https://mcp.crow-tit.com/sse",
-        "modes": ["chat", "paper"],
+        "modes": ("chat", "paper"),
     },
     "chrome_devtools": {
         "type": "stdio",
         "command": "npx",
-        "args": ["chrome-devtools-mcp@latest", "--browserUrl", "http://127.0.0.1:9222"],
-        "modes": ["code", "paper"],
+        "args": ("chrome-devtools-mcp@latest", "--browserUrl", "http://127.0.0.1:9222"),
+        "modes": ("code", "paper"),
     }
 }
+# Read-only view; take a mutable copy with mcp_server_copy() before changing anything
+DEFAULT_MCP_SERVERS = MappingProxyType({k: MappingProxyType(v) for k, v in _DEFAULT_MCP_SERVERS.items()})
+
+
+def mcp_server_copy(server) -> dict:
+    """Mutable copy of an MCP server config (tuples become lists)"""
+    return {k: list(v) if isinstance(v, tuple) else v for k, v in server.items()}
+
 
 # ========================
 # Chat mode settings
 # ========================
 CHAT_SYSTEM_PROMPT = f"You are a helpful, friendly AI assistant. When the user attaches files, they are saved to {ATTACHMENTS_DIR}/. Use the Read tool to read those files when referenced. Only use the Read tool for files in that directory."
-
-# ========================
-# Utility functions
-# ========================
-def run_local_command(command: str, timeout: int = 30) -> tuple[bool, str]:
-    """Helper to execute a local shell command."""
-    try:
-        result = subprocess.run(
-            ["bash", "-c", command],
-            capture_output=True, text=True, timeout=timeout
-        )
-        return result.returncode == 0, result.stdout.strip() if result.returncode == 0 else result.stderr.strip()
-    except subprocess.TimeoutExpired:
-        return False, "Timeout"
-    except Exception as e:
-        return False, str(e)
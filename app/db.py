@@ -1,42 +1,158 @@
+import atexit
+import threading
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 from contextlib import contextmanager
-from datetime import datetime
 from typing import Optional
-import json
+import time
+
+from app.config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, DB_POOL_MIN, DB_POOL_MAX
+
+class _Connection(psycopg2.extensions.connection):
+    """Pooled autocommit connection that remembers which statements it has PREPAREd"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.autocommit = True
+        self.prepared = set()
+
+
+class Prepared:
+    """Server-side prepared statement (PREPAREd lazily on each pooled connection)"""
+
+    def __init__(self, name: str, argtypes: tuple, sql: str):
+        self.name = name
+        self.prepare_sql = f"PREPARE {name}({', '.join(argtypes)}) AS {sql}"
+        self.execute_sql = f"EXECUTE {name}({', '.join(['%s'] * len(argtypes))})"
+
+
+# Process-wide connection pool (keeps up to DB_POOL_MIN idle connections open).
+# The semaphore makes callers wait instead of failing when all DB_POOL_MAX connections are busy.
+_pool = psycopg2.pool.ThreadedConnectionPool(
+    DB_POOL_MIN, DB_POOL_MAX,
+    host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+    connection_factory=_Connection
+)
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+atexit.register(_pool.closeall)
 
-from app.config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
 
 @contextmanager
 def get_conn():
-    """PostgreSQL connection context manager"""
-    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+    """PostgreSQL connection context manager (borrowed from the pool)"""
+    _pool_slots.acquire()
     try:
-        yield conn
+        conn = _pool.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            # Broken connections are discarded
+            _pool.putconn(conn, close=broken or conn.closed != 0)
     finally:
-        conn.close()
+        _pool_slots.release()
+
+
+@contextmanager
+def transaction():
+    """Pooled connection inside one explicit transaction (commit on success, rollback on error).
+    Plain get_conn() is autocommit, so only multi-statement writes need this."""
+    with get_conn() as conn:
+        conn.autocommit = False
+        try:
+            with conn:
+                yield conn
+        finally:
+            if not conn.closed:
+                conn.autocommit = True
+
+
+def _execute(cur, query, params=None):
+    """Execute a SQL string or a Prepared statement (PREPAREd on first use per connection)"""
+    if not isinstance(query, Prepared):
+        cur.execute(query, params)
+        return
+    prepared = cur.connection.prepared
+    if query.name not in prepared:
+        cur.execute(query.prepare_sql)
+        prepared.add(query.name)
+    cur.execute(query.execute_sql, params)
 
 
 def _fetchone(conn, query, params=None):
-    """Fetch single row → dict or None"""
+    """Fetch single row → dict (RealDictRow) or None"""
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(query, params)
-        row = cur.fetchone()
-    return dict(row) if row else None
+        _execute(cur, query, params)
+        return cur.fetchone()
 
 
 def _fetchall(conn, query, params=None):
-    """Fetch multiple rows → list[dict]"""
+    """Fetch multiple rows → list[dict] (RealDictRow, no copy)"""
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(query, params)
-        rows = cur.fetchall()
-    return [dict(row) for row in rows]
+        _execute(cur, query, params)
+        return cur.fetchall()
 
 
-def init_db():
-    """Initialize database"""
+# Bump whenever init_db's DDL/migrations change; a matching DB skips them entirely
+SCHEMA_VERSION = "3"
+
+MESSAGES_PARTITIONS = 16
+
+# Partitioned by session_id, so the key has to be part of the primary key; every hot path filters on it
+_MESSAGES_DDL = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        reasoning JSONB,
+        thinking_label TEXT,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        PRIMARY KEY (id, session_id),
+        FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
+    ) PARTITION BY HASH (session_id)
+"""
+
+
+def _schema_version() -> Optional[str]:
+    """Schema version recorded in settings (None on a fresh database)"""
     with get_conn() as conn:
+        if not _fetchval(conn, "SELECT to_regclass('public.settings') IS NOT NULL"):
+            return None
+        return _fetchval(conn, "SELECT value FROM settings WHERE key = 'schema_version'")
+
+
+def _create_message_partitions(cur):
+    """Create any missing messages hash partitions"""
+    for remainder in range(MESSAGES_PARTITIONS):
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS messages_p{remainder} PARTITION OF messages "
+            f"FOR VALUES WITH (MODULUS {MESSAGES_PARTITIONS}, REMAINDER {remainder})"
+        )
+
+
+def _fetchval(conn, query, params=None):
+    """Fetch the first column of the first row → value or None"""
+    with conn.cursor() as cur:
+        _execute(cur, query, params)
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def init_db():
+    """Initialize database (no-op when the schema is already at SCHEMA_VERSION)"""
+    if _schema_version() == SCHEMA_VERSION:
+        return
+    with transaction() as conn:
         with conn.cursor() as cur:
+            # Serialize concurrent workers running the migration
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('ddoli_init_db'))")
+
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS sessions (
                     id TEXT PRIMARY KEY,
@@ -44,30 +160,20 @@ def init_db():
                     mode TEXT DEFAULT 'chat',
                     context_percent REAL DEFAULT 0,
                     archived INTEGER DEFAULT 0,
-                    created_at TEXT DEFAULT (NOW()::TEXT),
-                    updated_at TEXT DEFAULT (NOW()::TEXT)
+                    created_at TIMESTAMPTZ DEFAULT NOW(),
+                    updated_at TIMESTAMPTZ DEFAULT NOW()
                 )
             """)
 
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id SERIAL PRIMARY KEY,
-                    session_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    reasoning TEXT,
-                    thinking_label TEXT,
-                    created_at TEXT DEFAULT (NOW()::TEXT),
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-            """)
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS messages_id_seq")
+            cur.execute(_MESSAGES_DDL)
 
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS commands (
                     id SERIAL PRIMARY KEY,
                     name TEXT NOT NULL UNIQUE,
                     content TEXT NOT NULL,
-                    created_at TEXT DEFAULT (NOW()::TEXT)
+                    created_at TIMESTAMPTZ DEFAULT NOW()
                 )
             """)
 
@@ -78,40 +184,185 @@ def init_db():
                 )
             """)
 
-        conn.commit()
+            # user_msg_count: maintained by add_message, backfilled once when the column is added
+            cur.execute(
+                "SELECT 1 FROM information_schema.columns WHERE table_name = 'sessions' AND column_name = 'user_msg_count'"
+            )
+            if not cur.fetchone():
+                cur.execute("ALTER TABLE sessions ADD COLUMN user_msg_count INTEGER NOT NULL DEFAULT 0")
+                cur.execute("""
+                    UPDATE sessions s SET user_msg_count = (
+                        SELECT COUNT(*) FROM messages m WHERE m.session_id = s.id AND m.role = 'user'
+                    )
+                """)
+
+            # reasoning: TEXT → JSONB (rows that never held valid JSON become NULL)
+            cur.execute(
+                "SELECT data_type FROM information_schema.columns WHERE table_name = 'messages' AND column_name = 'reasoning'"
+            )
+            if cur.fetchone()[0] != "jsonb":
+                cur.execute("""
+                    CREATE OR REPLACE FUNCTION pg_temp.try_jsonb(t TEXT) RETURNS JSONB AS $$
+                    BEGIN
+                        RETURN t::jsonb;
+                    EXCEPTION WHEN others THEN
+                        RETURN NULL;
+                    END
+                    $$ LANGUAGE plpgsql
+                """)
+                cur.execute("ALTER TABLE messages ALTER COLUMN reasoning TYPE JSONB USING pg_temp.try_jsonb(reasoning)")
+
+            # *_at: TEXT → TIMESTAMPTZ (unparseable legacy values fall back to the migration time)
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION pg_temp.try_timestamptz(t TEXT) RETURNS TIMESTAMPTZ AS $$
+                BEGIN
+                    RETURN t::timestamptz;
+                EXCEPTION WHEN others THEN
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            """)
+            for table, column in (("sessions", "created_at"), ("sessions", "updated_at"),
+                                  ("messages", "created_at"), ("commands", "created_at")):
+                cur.execute(
+                    "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+                    (table, column)
+                )
+                if cur.fetchone()[0] == "timestamp with time zone":
+                    continue
+                cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT")
+                cur.execute(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMPTZ "
+                    f"USING COALESCE(pg_temp.try_timestamptz({column}), NOW())"
+                )
+                cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT NOW()")
+
+            # messages: plain heap → MESSAGES_PARTITIONS hash partitions on session_id
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass")
+            if cur.fetchone()[0] != "p":
+                cur.execute("DROP INDEX IF EXISTS idx_messages_session_created, idx_messages_session_role")
+                cur.execute("ALTER INDEX IF EXISTS messages_pkey RENAME TO messages_unpartitioned_pkey")
+                cur.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+                cur.execute("ALTER SEQUENCE messages_id_seq OWNED BY NONE")
+                cur.execute(_MESSAGES_DDL)
+                _create_message_partitions(cur)
+                cur.execute("""
+                    INSERT INTO messages (id, session_id, role, content, reasoning, thinking_label, created_at)
+                    SELECT id, session_id, role, content, reasoning, thinking_label, created_at FROM messages_unpartitioned
+                """)
+                cur.execute("DROP TABLE messages_unpartitioned")
+            _create_message_partitions(cur)
+            cur.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+
+            # Indexes matching the hot WHERE/ORDER BY shapes (no seq scan + sort)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_created ON messages (session_id, created_at, id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_role ON messages (session_id, role)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_mode_updated ON sessions (mode, updated_at DESC)")
+
+            cur.execute(
+                "INSERT INTO settings (key, value) VALUES ('schema_version', %s) "
+                "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+                (SCHEMA_VERSION,)
+            )
+
+
+
+# ========== Prepared statements (hot paths) ==========
+
+GET_SESSION = Prepared("get_session_stmt", ("text",), "SELECT * FROM sessions WHERE id = $1")
+SESSION_EXISTS = Prepared("session_exists_stmt", ("text",), "SELECT 1 FROM sessions WHERE id = $1")
+GET_MESSAGES = Prepared(
+    "get_messages_stmt", ("text",),
+    "SELECT * FROM messages WHERE session_id = $1 ORDER BY created_at ASC, id ASC"
+)
+INSERT_MESSAGE = Prepared(
+    "insert_message_stmt", ("text", "text", "text", "jsonb"),
+    """WITH ins AS (
+           INSERT INTO messages (session_id, role, content, reasoning, created_at)
+           VALUES ($1, $2, $3, $4, NOW()) RETURNING id
+       ), upd AS (
+           UPDATE sessions SET updated_at = NOW(), user_msg_count = user_msg_count + ($2 = 'user')::int
+           WHERE id = $1
+       )
+       SELECT id FROM ins"""
+)
+# Same as INSERT_MESSAGE, but also creates the mode session on first use.
+# A session inserted here is invisible to the upd CTE (shared snapshot), so its counters start pre-filled.
+ADD_MODE_MESSAGE = Prepared(
+    "add_mode_message_stmt", ("text", "text", "text", "jsonb", "text", "text"),
+    """WITH new_session AS (
+           INSERT INTO sessions (id, title, mode, created_at, updated_at, user_msg_count)
+           VALUES ($1, $5, $6, NOW(), NOW(), ($2 = 'user')::int)
+           ON CONFLICT (id) DO NOTHING
+       ), ins AS (
+           INSERT INTO messages (session_id, role, content, reasoning, created_at)
+           VALUES ($1, $2, $3, $4, NOW()) RETURNING id
+       ), upd AS (
+           UPDATE sessions SET updated_at = NOW(), user_msg_count = user_msg_count + ($2 = 'user')::int
+           WHERE id = $1
+       )
+       SELECT id FROM ins"""
+)
+TOUCH_SESSION = Prepared(
+    "touch_session_stmt", ("integer", "text"),
+    "UPDATE sessions SET updated_at = NOW(), user_msg_count = user_msg_count + $1 WHERE id = $2"
+)
+COUNT_USER_MESSAGES = Prepared(
+    "count_user_messages_stmt", ("text",),
+    "SELECT user_msg_count FROM sessions WHERE id = $1"
+)
+GET_SETTING = Prepared("get_setting_stmt", ("text",), "SELECT value FROM settings WHERE key = $1")
+SET_SETTING = Prepared(
+    "set_setting_stmt", ("text", "text"),
+    "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value"
+)
+# Creates the session archived on first toggle, otherwise flips the flag
+TOGGLE_ARCHIVE = Prepared(
+    "toggle_archive_stmt", ("text", "text", "text"),
+    """INSERT INTO sessions (id, title, mode, archived, created_at, updated_at)
+       VALUES ($1, $2, $3, 1, NOW(), NOW())
+       ON CONFLICT (id) DO UPDATE SET archived = CASE WHEN COALESCE(sessions.archived, 0) <> 0 THEN 0 ELSE 1 END
+       RETURNING archived"""
+)
+GET_COMMAND_BY_NAME = Prepared("get_command_by_name_stmt", ("text",), "SELECT * FROM commands WHERE name = $1")
+GET_COMMANDS_BY_NAMES = Prepared("get_commands_by_names_stmt", ("text[]",), "SELECT * FROM commands WHERE name = ANY($1)")
 
 
 # ========== Sessions ==========
 
 def create_session(session_id: str, mode: str = "chat", title: str = "New Chat") -> dict:
     """Create a new session"""
-    now = datetime.now().isoformat()
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO sessions (id, title, mode, created_at, updated_at) VALUES (%s, %s, %s, %s, %s)",
-                (session_id, title, mode, now, now)
+                "INSERT INTO sessions (id, title, mode, created_at, updated_at) VALUES (%s, %s, %s, NOW(), NOW()) RETURNING created_at",
+                (session_id, title, mode)
             )
-        conn.commit()
-    return {"id": session_id, "title": title, "mode": mode, "created_at": now}
+            created_at = cur.fetchone()[0]
+    _invalidate_mode_state()
+    return {"id": session_id, "title": title, "mode": mode, "created_at": created_at}
 
 
 def get_session(session_id: str) -> Optional[dict]:
     """Get a session by ID"""
     with get_conn() as conn:
-        return _fetchone(conn, "SELECT * FROM sessions WHERE id = %s", (session_id,))
+        return _fetchone(conn, GET_SESSION, (session_id,))
+
+
+def session_exists(session_id: str) -> bool:
+    """Check whether a session exists"""
+    with get_conn() as conn:
+        return _fetchval(conn, SESSION_EXISTS, (session_id,)) is not None
 
 
 def update_session_title(session_id: str, title: str):
     """Update session title"""
-    now = datetime.now().isoformat()
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "UPDATE sessions SET title = %s, updated_at = %s WHERE id = %s",
-                (title, now, session_id)
+                "UPDATE sessions SET title = %s, updated_at = NOW() WHERE id = %s",
+                (title, session_id)
             )
-        conn.commit()
 
 
 def get_sessions_by_mode(mode: str, limit: int = 50) -> list:
@@ -125,66 +376,83 @@ def get_sessions_by_mode(mode: str, limit: int = 50) -> list:
 
 
 def delete_session(session_id: str):
-    """Delete a session and its associated messages"""
+    """Delete a session (messages go with it via ON DELETE CASCADE)"""
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM messages WHERE session_id = %s", (session_id,))
             cur.execute("DELETE FROM sessions WHERE id = %s", (session_id,))
-        conn.commit()
+    _invalidate_mode_state()
+    _archived_cache.invalidate()
 
 
 def delete_all_sessions_by_mode(mode: str):
-    """Delete all sessions for a given mode"""
-    with get_conn() as conn:
+    """Delete all sessions for a given mode (messages cascade)"""
+    with transaction() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "DELETE FROM messages WHERE session_id IN (SELECT id FROM sessions WHERE mode = %s)",
-                (mode,)
-            )
+            # Bulk cleanup: skip waiting on the WAL flush for this transaction only
+            cur.execute("SET LOCAL synchronous_commit = off")
             cur.execute("DELETE FROM sessions WHERE mode = %s", (mode,))
-        conn.commit()
+    _invalidate_mode_state()
+    _archived_cache.invalidate(mode)
 
 
 # ========== Messages ==========
 
-def add_message(session_id: str, role: str, content: str, reasoning: str = None) -> int:
-    """Add a message to a session"""
-    now = datetime.now().isoformat()
+def _json_or_none(value):
+    """Adapt a Python value for a JSONB parameter (empty → NULL)"""
+    return psycopg2.extras.Json(value) if value else None
+
+
+def add_message(session_id: str, role: str, content: str, reasoning: list = None) -> int:
+    """Add a message to a session (reasoning: tool events, stored as JSONB)"""
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO messages (session_id, role, content, reasoning, created_at) VALUES (%s, %s, %s, %s, %s) RETURNING id",
-                (session_id, role, content, reasoning, now)
-            )
+            _execute(cur, INSERT_MESSAGE, (session_id, role, content, _json_or_none(reasoning)))
             message_id = cur.fetchone()[0]
-            cur.execute(
-                "UPDATE sessions SET updated_at = %s WHERE id = %s",
-                (now, session_id)
-            )
-        conn.commit()
+    _invalidate_mode_state()
     return message_id
 
 
+def add_messages_bulk(session_id: str, items: list) -> list:
+    """Add many messages to a session in one batch. items: [(role, content, reasoning), ...] → ids"""
+    if not items:
+        return []
+    rows = [(session_id, role, content, _json_or_none(reasoning)) for role, content, reasoning in items]
+    with transaction() as conn:
+        with conn.cursor() as cur:
+            ids = psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO messages (session_id, role, content, reasoning, created_at) VALUES %s RETURNING id",
+                rows, template="(%s, %s, %s, %s, NOW())", page_size=1000, fetch=True
+            )
+            user_count = sum(1 for item in items if item[0] == "user")
+            _execute(cur, TOUCH_SESSION, (user_count, session_id))
+    _invalidate_mode_state()
+    return [row[0] for row in ids]
+
+
 def count_user_messages(session_id: str) -> int:
     """Count user messages in a session"""
     with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT COUNT(*) as cnt FROM messages WHERE session_id = %s AND role = 'user'",
-                (session_id,)
-            )
-            row = cur.fetchone()
-    return row[0] if row else 0
+        return _fetchval(conn, COUNT_USER_MESSAGES, (session_id,)) or 0
 
 
 def get_messages(session_id: str) -> list:
     """Get all messages for a session"""
     with get_conn() as conn:
-        return _fetchall(
-            conn,
-            "SELECT * FROM messages WHERE session_id = %s ORDER BY created_at ASC",
-            (session_id,)
-        )
+        return _fetchall(conn, GET_MESSAGES, (session_id,))
+
+
+def iter_messages(session_id: str, itersize: int = 1000):
+    """Stream a session's messages through a server-side cursor (itersize rows in memory at a time).
+    Holds a pooled connection until the iteration finishes or the generator is closed."""
+    with transaction() as conn:
+        with conn.cursor(name="iter_messages", cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.itersize = itersize
+            cur.execute(
+                "SELECT * FROM messages WHERE session_id = %s ORDER BY created_at ASC, id ASC",
+                (session_id,)
+            )
+            yield from cur
 
 
 # ========== Mode-shared functions (code/paper) ==========
@@ -194,25 +462,29 @@ def _mode_sid(mode: str, name: str) -> str:
     return f"{mode}_{name}"
 
 
-def _get_or_create_mode_session(mode: str, name: str) -> dict:
-    """Get or create a session for a given mode"""
-    session_id = _mode_sid(mode, name)
-    session = get_session(session_id)
-    if session:
-        return session
-    return create_session(session_id, mode=mode, title=name)
-
-
 def get_mode_messages(mode: str, name: str) -> list:
     """Get messages for a given mode"""
     return get_messages(_mode_sid(mode, name))
 
 
+def iter_mode_messages(mode: str, name: str):
+    """Stream messages for a given mode (see iter_messages)"""
+    return iter_messages(_mode_sid(mode, name))
+
+
+def get_mode_last_message_id(mode: str, name: str) -> Optional[int]:
+    """Get the newest message id for a given mode session (None if empty)"""
+    return get_mode_state(mode)["last_message_id"].get(name)
+
+
 def add_mode_message(mode: str, name: str, role: str, content: str, events: list = None) -> int:
-    """Add a message for a given mode (optionally including events)"""
-    _get_or_create_mode_session(mode, name)
-    events_json = json.dumps(events) if events else None
-    return add_message(_mode_sid(mode, name), role, content, reasoning=events_json)
+    """Add a message for a given mode (optionally including events), creating the session if needed"""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            _execute(cur, ADD_MODE_MESSAGE, (_mode_sid(mode, name), role, content, _json_or_none(events), name, mode))
+            message_id = cur.fetchone()[0]
+    _invalidate_mode_state()
+    return message_id
 
 
 def clear_mode_session(mode: str, name: str):
@@ -220,9 +492,12 @@ def clear_mode_session(mode: str, name: str):
     session_id = _mode_sid(mode, name)
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM messages WHERE session_id = %s", (session_id,))
-            cur.execute("UPDATE sessions SET context_percent = 0 WHERE id = %s", (session_id,))
-        conn.commit()
+            cur.execute(
+                """WITH del AS (DELETE FROM messages WHERE session_id = %s)
+                   UPDATE sessions SET context_percent = 0, user_msg_count = 0 WHERE id = %s""",
+                (session_id, session_id)
+            )
+    _invalidate_mode_state()
 
 
 def update_context_percent_by_session(session_id: str, percent: float):
@@ -233,14 +508,13 @@ def update_context_percent_by_session(session_id: str, percent: float):
                 "UPDATE sessions SET context_percent = %s WHERE id = %s",
                 (percent, session_id)
             )
-        conn.commit()
+    _invalidate_mode_state()
 
 
 def get_context_percent_by_session(session_id: str) -> float:
     """Get context percent for a session"""
     with get_conn() as conn:
-        row = _fetchone(conn, "SELECT context_percent FROM sessions WHERE id = %s", (session_id,))
-    return row["context_percent"] if row and row["context_percent"] else 0
+        return _fetchval(conn, "SELECT context_percent FROM sessions WHERE id = %s", (session_id,)) or 0
 
 
 def update_mode_context_percent(mode: str, name: str, percent: float):
@@ -250,34 +524,80 @@ def update_mode_context_percent(mode: str, name: str, percent: float):
 
 def get_mode_context_percent(mode: str, name: str) -> float:
     """Get context percent for a given mode"""
-    return get_context_percent_by_session(_mode_sid(mode, name))
+    return get_mode_state(mode)["context_percent"].get(name, 0)
 
 
 def archive_mode_project(mode: str, name: str):
     """Toggle archive status for a mode project"""
-    session_id = _mode_sid(mode, name)
-    session = get_session(session_id)
-    if not session:
-        create_session(session_id, mode=mode, title=name)
-        session = get_session(session_id)
-    new_val = 0 if session.get("archived", 0) else 1
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("UPDATE sessions SET archived = %s WHERE id = %s", (new_val, session_id))
-        conn.commit()
+            _execute(cur, TOGGLE_ARCHIVE, (_mode_sid(mode, name), name, mode))
+            new_val = cur.fetchone()[0]
+    _invalidate_mode_state()
+    _archived_cache.invalidate(mode)
     return new_val
 
 
-def get_archived_projects(mode: str) -> list:
-    """Get list of archived project names"""
+def _load_archived_projects(mode: str) -> tuple:
+    """Query archived project names for a mode (most recent first)"""
+    prefix = _mode_sid(mode, "")
     with get_conn() as conn:
         rows = _fetchall(
             conn,
-            "SELECT id FROM sessions WHERE mode = %s AND archived = 1 ORDER BY updated_at DESC",
-            (mode,)
+            """SELECT substring(id FROM %s) AS name FROM sessions
+               WHERE mode = %s AND left(id, %s) = %s AND archived = 1
+               ORDER BY updated_at DESC""",
+            (len(prefix) + 1, mode, len(prefix), prefix)
         )
-    prefix = f"{mode}_"
-    return [row["id"][len(prefix):] for row in rows if row["id"].startswith(prefix)]
+    return tuple(row["name"] for row in rows)
+
+
+def get_archived_projects(mode: str) -> tuple:
+    """Get archived project names, most recent first (cached until an archive toggle or session delete;
+    unlike get_mode_state, message writes do not invalidate it)"""
+    return _archived_cache.get(mode, _load_archived_projects)
+
+
+# ========== Mode state snapshot ==========
+
+MODE_STATE_TTL = 2.0
+_mode_state_cache = {}  # {mode: (ts, state)}
+_mode_state_version = 0
+
+
+def _invalidate_mode_state():
+    """Drop cached mode snapshots (called after session/message writes)"""
+    global _mode_state_version
+    _mode_state_version += 1
+    _mode_state_cache.clear()
+
+
+def get_mode_state(mode: str) -> dict:
+    """Snapshot of a mode's project sessions in one query (cached for MODE_STATE_TTL).
+    Returns: {"last_message_id": {name: id}, "context_percent": {name: pct}}"""
+    now = time.monotonic()
+    cached = _mode_state_cache.get(mode)
+    if cached and now - cached[0] < MODE_STATE_TTL:
+        return cached[1]
+    version = _mode_state_version
+    prefix = _mode_sid(mode, "")
+    with get_conn() as conn:
+        rows = _fetchall(
+            conn,
+            """SELECT substring(s.id FROM %s) AS name, s.context_percent, m.last_id
+               FROM sessions s
+               LEFT JOIN LATERAL (SELECT MAX(id) AS last_id FROM messages WHERE session_id = s.id) m ON TRUE
+               WHERE s.mode = %s AND left(s.id, %s) = %s""",
+            (len(prefix) + 1, mode, len(prefix), prefix)
+        )
+    state = {
+        "last_message_id": {row["name"]: row["last_id"] for row in rows},
+        "context_percent": {row["name"]: row["context_percent"] or 0 for row in rows},
+    }
+    # Skip storing if a write raced with the query (same rule as _LookupCache)
+    if version == _mode_state_version:
+        _mode_state_cache[mode] = (now, state)
+    return state
 
 
 def delete_mode_project(mode: str, name: str):
@@ -285,6 +605,68 @@ def delete_mode_project(mode: str, name: str):
     delete_session(_mode_sid(mode, name))
 
 
+# ========== Lookup cache (settings / commands) ==========
+
+_MISSING = object()
+
+
+class _LookupCache:
+    """In-process cache for read-mostly lookups; every write path in this module invalidates it.
+    (Single app process, so no cross-process invalidation is needed.)"""
+
+    def __init__(self, maxsize: int = 1024):
+        self._data = {}
+        self._version = 0
+        self._maxsize = maxsize
+
+    def get(self, key, load):
+        value = self._data.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        version = self._version
+        value = load(key)
+        # Skip storing if a write raced with the load
+        if version == self._version:
+            if len(self._data) >= self._maxsize:
+                self._data.clear()
+            self._data[key] = value
+        return value
+
+    def get_many(self, keys, load_many):
+        """Like get() for several keys; misses are loaded with one load_many(list) -> {key: value} call"""
+        found, missing = {}, []
+        for key in keys:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            version = self._version
+            loaded = load_many(missing)
+            store = version == self._version
+            if store and len(self._data) + len(missing) > self._maxsize:
+                self._data.clear()
+            for key in missing:
+                value = loaded.get(key)
+                found[key] = value
+                if store:
+                    self._data[key] = value
+        return found
+
+    def invalidate(self, key=_MISSING):
+        self._version += 1
+        if key is _MISSING:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+
+_settings_cache = _LookupCache()
+_commands_cache = _LookupCache()
+_archived_cache = _LookupCache()
+
+
 # ========== Commands ==========
 
 def get_commands() -> list:
@@ -300,23 +682,38 @@ def get_command(command_id: int) -> Optional[dict]:
 
 
 def get_command_by_name(name: str) -> Optional[dict]:
-    """Get a command by name"""
+    """Get a command by name (cached)"""
+    return _commands_cache.get(name, _load_command_by_name)
+
+
+def _load_command_by_name(name: str) -> Optional[dict]:
+    """Fetch a command by name from the DB"""
+    with get_conn() as conn:
+        return _fetchone(conn, GET_COMMAND_BY_NAME, (name,))
+
+
+def get_commands_by_names(names) -> dict:
+    """Get several commands by name in one query (cached) → {name: command or None}"""
+    return _commands_cache.get_many(names, _load_commands_by_names)
+
+
+def _load_commands_by_names(names: list) -> dict:
+    """Fetch commands by name from the DB in a single round-trip"""
     with get_conn() as conn:
-        return _fetchone(conn, "SELECT * FROM commands WHERE name = %s", (name,))
+        return {row["name"]: row for row in _fetchall(conn, GET_COMMANDS_BY_NAMES, (list(names),))}
 
 
 def create_command(name: str, content: str) -> dict:
     """Create a new command"""
-    now = datetime.now().isoformat()
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO commands (name, content, created_at) VALUES (%s, %s, %s) RETURNING id",
-                (name, content, now)
+                "INSERT INTO commands (name, content, created_at) VALUES (%s, %s, NOW()) RETURNING id, created_at",
+                (name, content)
             )
-            command_id = cur.fetchone()[0]
-        conn.commit()
-    return {"id": command_id, "name": name, "content": content, "created_at": now}
+            command_id, created_at = cur.fetchone()
+    _commands_cache.invalidate(name)
+    return {"id": command_id, "name": name, "content": content, "created_at": created_at}
 
 
 def update_command(command_id: int, name: str = None, content: str = None) -> bool:
@@ -339,7 +736,7 @@ def update_command(command_id: int, name: str = None, content: str = None) -> bo
                 f"UPDATE commands SET {', '.join(updates)} WHERE id = %s", params
             )
             affected = cur.rowcount
-        conn.commit()
+    _commands_cache.invalidate()
     return affected > 0
 
 
@@ -349,28 +746,29 @@ def delete_command(command_id: int) -> bool:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM commands WHERE id = %s", (command_id,))
             affected = cur.rowcount
-        conn.commit()
+    _commands_cache.invalidate()
     return affected > 0
 
 
 # ========== Settings ==========
 
 def get_setting(key: str) -> Optional[str]:
-    """Get a setting value"""
+    """Get a setting value (cached)"""
+    return _settings_cache.get(key, _load_setting)
+
+
+def _load_setting(key: str) -> Optional[str]:
+    """Fetch a setting value from the DB"""
     with get_conn() as conn:
-        row = _fetchone(conn, "SELECT value FROM settings WHERE key = %s", (key,))
-    return row["value"] if row else None
+        return _fetchval(conn, GET_SETTING, (key,))
 
 
 def set_setting(key: str, value: str):
     """Save a setting value (upsert)"""
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
-                (key, value)
-            )
-        conn.commit()
+            _execute(cur, SET_SETTING, (key, value))
+    _settings_cache.invalidate(key)
 
 
 # Initialize DB on app startup
@@ -4,57 +4,152 @@ Paper mode API router
 - Project (paper) / file management
 - SSE streaming
 """
-from fastapi import APIRouter, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import APIRouter, Form, Request
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
+import asyncio
+import fcntl
+import os
 import re
-import json
-import base64
+import shutil
+import time
+import orjson
 
 from app import db
-from app.config import PAPERS_DIR, TEMPLATES_DIR, run_local_command
+from app.config import PAPERS_DIR, TEMPLATES_DIR
 from app.shared import (
-    mode_chat_handler, mode_stream_sse,
-    mode_status_response, mode_active_response, mode_file_content, mode_file_write,
+    BoundedResponses, mode_chat_handler, mode_stream_sse,
+    mode_status_response, mode_active_response, mode_cancel_response, mode_file_content, mode_file_write,
     make_file_raw_response, make_file_download_response,
     mode_delete_file, mode_create_file, mode_create_folder, mode_list_directories,
-    render_file_tree_html,
+    make_file_tree_response, invalidate_file_tree, project_locks,
     mode_clear_session, mode_context_percent, mode_messages_html
 )
 
 router = APIRouter()
 
+# Lowercase letters, digits and single inner hyphens (no leading/trailing/double hyphen)
+_PAPER_NAME_RE = re.compile(r'^(?!-)(?!.*--)[a-z0-9-]+(?<!-)\Z')
+_PAPER_CHARS_RE = re.compile(r'^[a-z0-9-]+\Z')
+
+
+def _validate_paper_name(name: str):
+    """Return an error message for an invalid paper name (None if valid)"""
+    if _PAPER_NAME_RE.match(name):
+        return None
+    if not _PAPER_CHARS_RE.match(name):
+        return "Paper name can only contain lowercase letters, numbers, and hyphens (-). (e.g., my-thesis)"
+    if '--' in name:
+        return "Paper name cannot contain consecutive hyphens (--)."
+    return "Paper name cannot start or end with a hyphen."
+
+
+_PAPERS_REAL = os.path.realpath(PAPERS_DIR)
+
+
+def _safe_paper_dir(name: str):
+    """Path of an existing paper, or None if the name would resolve outside PAPERS_DIR.
+    Only rejects traversal: papers created before the naming rule must stay reachable"""
+    if not name or os.sep in name or '\0' in name or name in (".", ".."):
+        return None
+    path = os.path.join(PAPERS_DIR, name)
+    if not os.path.realpath(path).startswith(_PAPERS_REAL + os.sep):
+        return None
+    return path
+
+
+def _bad_paper_param(paper: str):
+    """400 response for a paper query/form value that escapes PAPERS_DIR (empty is left to the file helpers)"""
+    if paper and not _safe_paper_dir(paper):
+        return JSONResponse({"error": "Invalid paper name."}, status_code=400)
+    return None
+
+
+def _paper_dir(name: str) -> str:
+    """Absolute path of a paper folder"""
+    return os.path.join(PAPERS_DIR, name)
+
+
+def _paper_exists(name: str) -> bool:
+    """Whether a paper folder exists (single stat, no subprocess)"""
+    return os.path.isdir(_paper_dir(name))
+
+
+def _paper_name_taken(name: str) -> bool:
+    """Whether anything (folder, file or dangling link) already uses this paper name"""
+    return os.path.lexists(_paper_dir(name))
+
+
+def _paper_move_state(source: str, target: str) -> tuple[bool, bool]:
+    """(source exists, target taken) for clone/rename, checked in one worker call"""
+    return _paper_exists(source), _paper_name_taken(target)
+
 # Session lock function injected from main.py
 get_session_lock = None
 
 # Shared state (accessed from main.py)
 active_paper_streams = {}  # {response_id: {"cancelled": bool, "process": subprocess or None}}
-paper_responses = {}  # {response_id: {"paper", "status", "events", ...}}
+paper_responses = BoundedResponses()  # {response_id: {"paper", "status", "events", ...}}
 
 
 # ========== Paper Project Management ==========
 
-@router.get("/paper/templates")
-async def get_templates():
-    """Retrieve list of available templates (including display_name)"""
-    success, output = run_local_command(f"mkdir -p {TEMPLATES_DIR} && ls -1 {TEMPLATES_DIR} 2>/dev/null")
-    if not success:
-        return JSONResponse([])
-    template_dirs = [t.strip() for t in output.split('\n') if t.strip()]
+# Listing caches keyed on the directory mtime (changes whenever an entry is added/removed/renamed).
+# metadata.json edits inside a template don't touch TEMPLATES_DIR, so templates also expire after a TTL.
+TEMPLATES_CACHE_TTL = 60.0
+_templates_cache = {"entry": (None, 0.0, None)}  # (mtime_ns, ts, templates)
+_papers_cache = {"entry": (None, None)}  # (mtime_ns, names)
 
-    # Read display_name from each template's metadata.json
+
+def ensure_paper_directories():
+    """Create the papers and templates roots once at startup (listings assume they exist)"""
+    os.makedirs(PAPERS_DIR, exist_ok=True)
+    os.makedirs(TEMPLATES_DIR, exist_ok=True)
+
+
+def _list_subdirs(base_dir: str) -> list:
+    """Sorted names of visible subdirectories in one scandir pass"""
+    with os.scandir(base_dir) as it:
+        # is_dir(follow_symlinks=False) answers from the dirent type, no per-entry stat
+        return sorted(e.name for e in it if e.is_dir(follow_symlinks=False) and not e.name.startswith('.'))
+
+
+def _list_templates() -> list:
+    """Templates with display_name read from each template's metadata.json (cached)"""
+    mtime = os.stat(TEMPLATES_DIR).st_mtime_ns
+    now = time.monotonic()
+    cached_mtime, cached_ts, cached = _templates_cache["entry"]
+    if cached_mtime == mtime and now - cached_ts < TEMPLATES_CACHE_TTL:
+        return cached
     templates = []
-    for tpl in template_dirs:
+    for tpl in _list_subdirs(TEMPLATES_DIR):
         display_name = tpl  # fallback: use folder name as-is
-        ok, meta_output = run_local_command(f"cat {TEMPLATES_DIR}/{tpl}/metadata.json 2>/dev/null")
-        if ok and meta_output:
-            try:
-                meta = json.loads(meta_output)
-                display_name = meta.get("display_name", tpl)
-            except (json.JSONDecodeError, ValueError):
-                pass
+        try:
+            with open(os.path.join(TEMPLATES_DIR, tpl, "metadata.json"), "rb") as f:
+                display_name = orjson.loads(f.read()).get("display_name", tpl)
+        except (OSError, ValueError, AttributeError):
+            pass
         templates.append({"value": tpl, "display_name": display_name})
+    _templates_cache["entry"] = (mtime, now, templates)
+    return templates
+
 
-    return JSONResponse(templates)
+def _list_papers() -> list:
+    """Paper folder names (cached until PAPERS_DIR's mtime changes)"""
+    mtime = os.stat(PAPERS_DIR).st_mtime_ns
+    cached_mtime, names = _papers_cache["entry"]
+    if cached_mtime != mtime:
+        names = _list_subdirs(PAPERS_DIR)
+        _papers_cache["entry"] = (mtime, names)
+    return names
+
+
+@router.get("/paper/templates")
+async def get_templates():
+    """Retrieve list of available templates (including display_name)"""
+    try:
+        return ORJSONResponse(await asyncio.to_thread(_list_templates))
+    except OSError:
+        return ORJSONResponse([])
 
 
 PAPER_CLAUDE_MD = """# {paper_name} - LaTeX Paper Project
@@ -119,6 +214,9 @@ To add a new section:
 - Build artifacts (`.aux`, `.log`, `.out`, etc.) should be excluded from deployment
 """
 
+# Unescaped, encoded and split around {paper_name} once at import; creation just joins with the name
+_PAPER_CLAUDE_MD_PARTS = PAPER_CLAUDE_MD.replace('{{', '{').replace('}}', '}').encode("utf-8").split(b'{paper_name}')
+
 # Default main.tex template
 PAPER_MAIN_TEX = r"""\documentclass[11pt,a4paper]{article}
 \usepackage{kotex}
@@ -205,44 +303,111 @@ PAPER_REFERENCES_BIB = r"""% BibTeX references file
 }
 """
 
+# Built-in LaTeX layout (pre-encoded), used when the requested template folder is missing
+_PAPER_DEFAULT_FILES = (
+    ("contents/main.tex", PAPER_MAIN_TEX.encode("utf-8")),
+    ("contents/abstract.tex", PAPER_ABSTRACT_TEX.encode("utf-8")),
+    ("contents/introduction.tex", PAPER_INTRODUCTION_TEX.encode("utf-8")),
+    ("references/references.bib", PAPER_REFERENCES_BIB.encode("utf-8")),
+)
+
+
+# Linux ioctl that shares a file's extents with another file (copy-on-write; btrfs/XFS)
+FICLONE = 0x40049409
+
+
+def _reflink_copy(src: str, dst: str) -> str:
+    """shutil.copy2 that first tries a copy-on-write clone; plain copy where reflinks are unsupported.
+    (No hardlinks: paper files are rewritten in place, which would write through to the template.)"""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return shutil.copy2(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _copy_template(template_dir: str, paper_dir: str):
+    """Copy a template's top-level entries into the paper folder (like `cp -r template/*`, minus metadata.json)
+    Returns False if the template folder does not exist"""
+    try:
+        with os.scandir(template_dir) as it:
+            entries = [e for e in it if not e.name.startswith('.') and e.name != "metadata.json"]
+    except OSError:
+        return False
+    for entry in entries:
+        target = os.path.join(paper_dir, entry.name)
+        try:
+            if entry.is_dir():
+                shutil.copytree(entry.path, target, symlinks=True, dirs_exist_ok=True, copy_function=_reflink_copy)
+            else:
+                _reflink_copy(entry.path, target)
+        except OSError:
+            pass
+    return True
+
+
+def _seed_default_paper(paper_dir: str):
+    """Write the built-in LaTeX skeleton (contents/, figures/, references/)"""
+    os.makedirs(os.path.join(paper_dir, "figures"), exist_ok=True)
+    for rel, data in _PAPER_DEFAULT_FILES:
+        path = os.path.join(paper_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def _clone_tree(src: str, dst: str):
+    """Copy a paper folder, using copy-on-write reflinks where the filesystem supports them"""
+    shutil.copytree(src, dst, symlinks=True, copy_function=_reflink_copy)
+
+
+def _init_paper_dir(paper_name: str, template: str):
+    """Create the paper folder from a template and make sure it has a CLAUDE.md"""
+    paper_dir = _paper_dir(paper_name)
+    os.makedirs(PAPERS_DIR, exist_ok=True)
+    os.mkdir(paper_dir)  # FileExistsError doubles as the duplicate check
+    if not _copy_template(os.path.join(TEMPLATES_DIR, template), paper_dir):
+        _seed_default_paper(paper_dir)
+    claude_md = os.path.join(paper_dir, "CLAUDE.md")
+    # Handled as bytes: paper names are ASCII, so no decode/encode round trip is needed
+    try:
+        with open(claude_md, "rb") as f:
+            claude_content = f.read()
+    except OSError:
+        claude_content = b""
+    if claude_content and b'{paper_name}' not in claude_content:
+        return
+    if claude_content:
+        # Template has its own CLAUDE.md: fill in the {paper_name} placeholder
+        claude_content = claude_content.replace(b'{paper_name}', paper_name.encode())
+    else:
+        # Template has no CLAUDE.md: generate the default LaTeX one
+        claude_content = paper_name.encode().join(_PAPER_CLAUDE_MD_PARTS)
+    with open(claude_md, "wb") as f:
+        f.write(claude_content)
+
 
 @router.post("/paper/new-paper")
 async def create_new_paper(paper_name: str = Form(...), template: str = Form("")):
     """Create a new paper project"""
-    if not re.match(r'^[a-z0-9-]+$', paper_name):
-        return JSONResponse({"error": "Paper name can only contain lowercase letters, numbers, and hyphens (-). (e.g., my-thesis)"}, status_code=400)
-    if paper_name.startswith('-') or paper_name.endswith('-'):
-        return JSONResponse({"error": "Paper name cannot start or end with a hyphen."}, status_code=400)
-    if '--' in paper_name:
-        return JSONResponse({"error": "Paper name cannot contain consecutive hyphens (--)."}, status_code=400)
-
-    # Check for duplicates
-    success, output = run_local_command(f"test -d {PAPERS_DIR}/{paper_name} && echo 'exists'")
-    if success and 'exists' in output:
-        return JSONResponse({"error": "A project with the same name already exists."}, status_code=409)
+    if error := _validate_paper_name(paper_name):
+        return JSONResponse({"error": error}, status_code=400)
 
     # Use basic template if none specified
     if not template:
         template = "basic"
+    if template != os.path.basename(template) or template.startswith('.') or '\0' in template:
+        return JSONResponse({"error": "Invalid template name."}, status_code=400)
 
-    # Create project root and copy template
-    success, output = run_local_command(f"mkdir -p {PAPERS_DIR}/{paper_name}")
-    if not success:
-        return JSONResponse({"error": f"Failed to create folder: {output}"}, status_code=500)
-    run_local_command(f"cp -r {TEMPLATES_DIR}/{template}/* {PAPERS_DIR}/{paper_name}/ 2>/dev/null || true")
-    # Remove metadata.json (template metadata, not needed in project)
-    run_local_command(f"rm -f {PAPERS_DIR}/{paper_name}/metadata.json 2>/dev/null")
-    # If the template has its own CLAUDE.md, replace {paper_name} placeholder
-    ok, claude_content = run_local_command(f"cat {PAPERS_DIR}/{paper_name}/CLAUDE.md 2>/dev/null")
-    if ok and claude_content and '{paper_name}' in claude_content:
-        claude_content = claude_content.replace('{paper_name}', paper_name)
-        claude_b64 = base64.b64encode(claude_content.encode()).decode()
-        run_local_command(f"echo '{claude_b64}' | base64 -d > {PAPERS_DIR}/{paper_name}/CLAUDE.md")
-    elif not ok or not claude_content:
-        # If template has no CLAUDE.md, generate default LaTeX one
-        claude_md_content = PAPER_CLAUDE_MD.format(paper_name=paper_name)
-        claude_md_b64 = base64.b64encode(claude_md_content.encode()).decode()
-        run_local_command(f"echo '{claude_md_b64}' | base64 -d > {PAPERS_DIR}/{paper_name}/CLAUDE.md")
+    # Create project root, copy template and write CLAUDE.md in one worker call
+    try:
+        await asyncio.to_thread(_init_paper_dir, paper_name, template)
+    except FileExistsError:
+        return JSONResponse({"error": "A project with the same name already exists."}, status_code=409)
+    except OSError as e:
+        return JSONResponse({"error": f"Failed to create folder: {e}"}, status_code=500)
 
     return JSONResponse({"success": True, "paper": paper_name})
 
@@ -252,22 +417,23 @@ async def clone_paper(source: str = Form(""), target: str = Form("")):
     """Clone a paper (copy files, new session)"""
     if not source or not target:
         return JSONResponse({"error": "Both source and target paper names are required."}, status_code=400)
-    if not re.match(r'^[a-z0-9-]+$', target):
-        return JSONResponse({"error": "Paper name can only contain lowercase letters, numbers, and hyphens (-)."}, status_code=400)
-    if target.startswith('-') or target.endswith('-') or '--' in target:
-        return JSONResponse({"error": "Invalid paper name format."}, status_code=400)
-    # Check if source exists
-    success, output = run_local_command(f"test -d {PAPERS_DIR}/{source} && echo 'exists'")
-    if not success or 'exists' not in output:
-        return JSONResponse({"error": f"Source paper '{source}' not found."}, status_code=404)
-    # Check for target duplicates
-    success, output = run_local_command(f"test -d {PAPERS_DIR}/{target} && echo 'exists'")
-    if success and 'exists' in output:
-        return JSONResponse({"error": f"Paper '{target}' already exists."}, status_code=409)
-    # Copy
-    success, output = run_local_command(f"cp -r {PAPERS_DIR}/{source} {PAPERS_DIR}/{target}")
-    if not success:
-        return JSONResponse({"error": f"Clone failed: {output}"}, status_code=500)
+    if not _safe_paper_dir(source):
+        return JSONResponse({"error": "Invalid source paper name."}, status_code=400)
+    if error := _validate_paper_name(target):
+        return JSONResponse({"error": error}, status_code=400)
+    # Check and copy span two awaits, so hold both names until the copy is done
+    async with project_locks("paper", source, target):
+        # Check source exists and target is free
+        source_exists, target_taken = await asyncio.to_thread(_paper_move_state, source, target)
+        if not source_exists:
+            return JSONResponse({"error": f"Source paper '{source}' not found."}, status_code=404)
+        if target_taken:
+            return JSONResponse({"error": f"Paper '{target}' already exists."}, status_code=409)
+        # Copy
+        try:
+            await asyncio.to_thread(_clone_tree, _paper_dir(source), _paper_dir(target))
+        except OSError as e:
+            return JSONResponse({"error": f"Clone failed: {e}"}, status_code=500)
     return JSONResponse({"success": True, "paper": target})
 
 
@@ -276,24 +442,25 @@ async def rename_paper(old_name: str = Form(""), new_name: str = Form("")):
     """Rename a paper (mv + delete existing DB session)"""
     if not old_name or not new_name:
         return JSONResponse({"error": "Both old name and new name are required."}, status_code=400)
-    if not re.match(r'^[a-z0-9-]+$', new_name):
-        return JSONResponse({"error": "Paper name can only contain lowercase letters, numbers, and hyphens (-)."}, status_code=400)
-    if new_name.startswith('-') or new_name.endswith('-') or '--' in new_name:
-        return JSONResponse({"error": "Invalid paper name format."}, status_code=400)
-    # Check if source exists
-    success, output = run_local_command(f"test -d {PAPERS_DIR}/{old_name} && echo 'exists'")
-    if not success or 'exists' not in output:
-        return JSONResponse({"error": f"Paper '{old_name}' not found."}, status_code=404)
-    # Check for target duplicates
-    success, output = run_local_command(f"test -d {PAPERS_DIR}/{new_name} && echo 'exists'")
-    if success and 'exists' in output:
-        return JSONResponse({"error": f"Paper '{new_name}' already exists."}, status_code=409)
-    # Rename
-    success, output = run_local_command(f"mv {PAPERS_DIR}/{old_name} {PAPERS_DIR}/{new_name}")
-    if not success:
-        return JSONResponse({"error": f"Rename failed: {output}"}, status_code=500)
-    # Delete existing DB session (reset conversation)
-    db.delete_mode_project("paper", old_name)
+    if not _safe_paper_dir(old_name):
+        return JSONResponse({"error": "Invalid paper name."}, status_code=400)
+    if error := _validate_paper_name(new_name):
+        return JSONResponse({"error": error}, status_code=400)
+    async with project_locks("paper", old_name, new_name):
+        # Check source exists and target is free
+        source_exists, target_taken = await asyncio.to_thread(_paper_move_state, old_name, new_name)
+        if not source_exists:
+            return JSONResponse({"error": f"Paper '{old_name}' not found."}, status_code=404)
+        if target_taken:
+            return JSONResponse({"error": f"Paper '{new_name}' already exists."}, status_code=409)
+        # Rename
+        try:
+            await asyncio.to_thread(os.rename, _paper_dir(old_name), _paper_dir(new_name))
+        except OSError as e:
+            return JSONResponse({"error": f"Rename failed: {e}"}, status_code=500)
+        invalidate_file_tree(PAPERS_DIR, old_name)
+        # Delete existing DB session (reset conversation)
+        await asyncio.to_thread(db.delete_mode_project, "paper", old_name)
     return JSONResponse({"success": True, "paper": new_name})
 
 
@@ -302,54 +469,76 @@ async def delete_paper(paper: str = ""):
     """Delete a paper (folder + DB)"""
     if not paper:
         return JSONResponse({"error": "Paper name is required."}, status_code=400)
-    if not re.match(r'^[a-z0-9-]+$', paper):
+    paper_dir = _safe_paper_dir(paper)
+    if not paper_dir:
         return JSONResponse({"error": "Invalid paper name."}, status_code=400)
 
-    success, output = run_local_command(f"rm -rf {PAPERS_DIR}/{paper}")
-    if not success:
-        return JSONResponse({"error": f"Failed to delete folder: {output}"}, status_code=500)
+    async with project_locks("paper", paper):
+        try:
+            await asyncio.to_thread(shutil.rmtree, paper_dir)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            return JSONResponse({"error": f"Failed to delete folder: {e}"}, status_code=500)
+        invalidate_file_tree(PAPERS_DIR, paper)
 
-    db.delete_mode_project("paper", paper)
+        await asyncio.to_thread(db.delete_mode_project, "paper", paper)
     return JSONResponse({"success": True, "message": f"Paper '{paper}' has been deleted."})
 
 
 @router.delete("/paper/file")
 async def delete_paper_file(paper: str = "", path: str = ""):
     """Delete a file"""
-    result, status_code = mode_delete_file(PAPERS_DIR, paper, path, name_pattern=r'^[a-z0-9-]+$')
+    if error := _bad_paper_param(paper):
+        return error
+    result, status_code = await asyncio.to_thread(mode_delete_file, PAPERS_DIR, paper, path, name_pattern=None)
     return JSONResponse(result, status_code=status_code)
 
 
 @router.post("/paper/create-file")
 async def create_paper_file(paper: str = Form(""), path: str = Form(""), filename: str = Form("")):
     """Create a file within a paper"""
-    result, status_code = mode_create_file(PAPERS_DIR, paper, path, filename, name_pattern=r'^[a-z0-9-]+$')
+    if error := _bad_paper_param(paper):
+        return error
+    result, status_code = await asyncio.to_thread(mode_create_file, PAPERS_DIR, paper, path, filename, name_pattern=None)
     return JSONResponse(result, status_code=status_code)
 
 
 @router.post("/paper/create-folder")
 async def create_paper_folder(paper: str = Form(""), path: str = Form(""), foldername: str = Form("")):
     """Create a folder within a paper"""
-    result, status_code = mode_create_folder(PAPERS_DIR, paper, path, foldername, name_pattern=r'^[a-z0-9-]+$')
+    if error := _bad_paper_param(paper):
+        return error
+    result, status_code = await asyncio.to_thread(mode_create_folder, PAPERS_DIR, paper, path, foldername, name_pattern=None)
     return JSONResponse(result, status_code=status_code)
 
 
 @router.get("/paper/list-dirs")
 async def list_paper_dirs(paper: str = ""):
     """List directories within a paper"""
-    dirs = mode_list_directories(PAPERS_DIR, paper)
-    return JSONResponse(dirs)
+    if error := _bad_paper_param(paper):
+        return error
+    dirs = await asyncio.to_thread(mode_list_directories, PAPERS_DIR, paper)
+    return ORJSONResponse(dirs)
 
 
 @router.get("/paper/papers-json")
 async def get_papers_json():
     """Retrieve paper list (excluding archived)"""
-    success, output = run_local_command(f"mkdir -p {PAPERS_DIR} && ls -1 {PAPERS_DIR} 2>/dev/null")
-    if not success:
-        return JSONResponse([])
-    archived = set(db.get_archived_projects("paper"))
-    papers = [p.strip() for p in output.split('\n') if p.strip() and p.strip() not in archived]
-    return JSONResponse([{"name": p} for p in papers])
+    # Directory scan and archived lookup run concurrently
+    names, archived = await asyncio.gather(
+        asyncio.to_thread(_list_papers),
+        asyncio.to_thread(db.get_archived_projects, "paper"),
+        return_exceptions=True
+    )
+    if isinstance(names, OSError):
+        return ORJSONResponse([])
+    for result in (names, archived):
+        if isinstance(result, BaseException):
+            raise result
+    archived = set(archived)
+    papers = [p for p in names if p not in archived]
+    return ORJSONResponse([{"name": p} for p in papers])
 
 
 # ========== File Explorer ==========
@@ -363,33 +552,44 @@ PAPER_EXT_COLORS = {
 
 
 @router.get("/paper/files", response_class=HTMLResponse)
-async def get_paper_files(paper: str = ""):
-    """Retrieve paper directory structure"""
-    return HTMLResponse(render_file_tree_html(PAPERS_DIR, paper, "paper", ext_colors=PAPER_EXT_COLORS))
+async def get_paper_files(request: Request, paper: str = ""):
+    """Retrieve paper directory structure (304 if unchanged since the client's ETag)"""
+    if error := _bad_paper_param(paper):
+        return error
+    return await asyncio.to_thread(make_file_tree_response, PAPERS_DIR, paper, "paper",
+                                   ext_colors=PAPER_EXT_COLORS, if_none_match=request.headers.get("if-none-match"))
 
 
 @router.get("/paper/file-content")
 async def get_paper_file_content(paper: str = "", path: str = ""):
     """Retrieve file content"""
-    return JSONResponse(mode_file_content(PAPERS_DIR, paper, path))
+    if error := _bad_paper_param(paper):
+        return error
+    return ORJSONResponse(await asyncio.to_thread(mode_file_content, PAPERS_DIR, paper, path))
 
 
 @router.get("/paper/file-raw")
-async def get_paper_file_raw(paper: str = "", path: str = ""):
+async def get_paper_file_raw(request: Request, paper: str = "", path: str = ""):
     """Retrieve media file binary (images/videos)"""
-    return make_file_raw_response(PAPERS_DIR, paper, path)
+    if error := _bad_paper_param(paper):
+        return error
+    return await asyncio.to_thread(make_file_raw_response, PAPERS_DIR, paper, path, request.headers.get("if-none-match"))
 
 
 @router.post("/paper/file-write")
 async def write_paper_file(paper: str = Form(""), path: str = Form(""), content: str = Form("")):
     """Save file content"""
-    return JSONResponse(mode_file_write(PAPERS_DIR, paper, path, content))
+    if error := _bad_paper_param(paper):
+        return error
+    return JSONResponse(await asyncio.to_thread(mode_file_write, PAPERS_DIR, paper, path, content))
 
 
 @router.get("/paper/file-download")
-async def download_paper_file(paper: str = "", path: str = ""):
+async def download_paper_file(request: Request, paper: str = "", path: str = ""):
     """Download a file"""
-    return make_file_download_response(PAPERS_DIR, paper, path)
+    if error := _bad_paper_param(paper):
+        return error
+    return await asyncio.to_thread(make_file_download_response, PAPERS_DIR, paper, path, request.headers.get("if-none-match"))
 
 
 # ========== Paper Mode Chat ==========
@@ -397,7 +597,7 @@ async def download_paper_file(paper: str = "", path: str = ""):
 @router.post("/paper", response_class=HTMLResponse)
 async def paper_chat(paper: str = Form(""), message: str = Form(""), mcp_tools: str = Form(""), file_map: str = Form(""), model: str = Form("sonnet")):
     """Send message to Claude CLI (paper writing)"""
-    return HTMLResponse(mode_chat_handler(
+    return HTMLResponse(await mode_chat_handler(
         "paper", paper, message, mcp_tools, file_map,
         PAPERS_DIR, paper_responses, active_paper_streams, get_session_lock,
         "paper and message", "Writing paper...", model=model
@@ -405,21 +605,27 @@ async def paper_chat(paper: str = Form(""), message: str = Form(""), mcp_tools:
 
 
 @router.get("/paper/stream")
-async def paper_stream(id: str = "", start_from: int = 0):
+async def paper_stream(request: Request, id: str = "", start_from: int = 0):
     """Stream Claude CLI output via SSE"""
-    return await mode_stream_sse(id, paper_responses, active_paper_streams, start_from)
+    return await mode_stream_sse(id, paper_responses, active_paper_streams, start_from, request=request)
 
 
 @router.get("/paper/status/{response_id}")
 async def get_paper_status(response_id: str):
     """Retrieve status of an in-progress paper response"""
-    return JSONResponse(mode_status_response(response_id, paper_responses, "paper"))
+    return ORJSONResponse(mode_status_response(response_id, paper_responses, "paper"))
 
 
 @router.get("/paper/active")
 async def get_active_papers(paper: str = ""):
     """Retrieve list of active response IDs for a paper"""
-    return JSONResponse(mode_active_response(paper_responses, "paper", paper))
+    return ORJSONResponse(mode_active_response(paper_responses, "paper", paper))
+
+
+@router.post("/paper/cancel")
+async def cancel_paper_response(id: str = Form("")):
+    """Stop a single in-flight paper response"""
+    return JSONResponse(mode_cancel_response(id, paper_responses, active_paper_streams))
 
 
 # ========== Session Management ==========
@@ -427,7 +633,7 @@ async def get_active_papers(paper: str = ""):
 @router.post("/paper/clear")
 async def clear_paper_session_endpoint(paper: str = Form("")):
     """Clear Paper mode session"""
-    result = mode_clear_session("paper", paper, "Paper")
+    result = await asyncio.to_thread(mode_clear_session, "paper", paper, "Paper")
     if result:
         return JSONResponse(result)
     return JSONResponse({"error": "Paper is required."}, status_code=400)
@@ -436,10 +642,10 @@ async def clear_paper_session_endpoint(paper: str = Form("")):
 @router.get("/paper/context")
 async def get_paper_context_percent(paper: str = ""):
     """Retrieve context percent for a paper"""
-    return JSONResponse(mode_context_percent("paper", paper))
+    return JSONResponse(await asyncio.to_thread(mode_context_percent, "paper", paper))
 
 
 @router.get("/paper/messages", response_class=HTMLResponse)
 async def get_paper_messages(paper: str = ""):
     """Return messages HTML for a paper"""
-    return HTMLResponse(mode_messages_html("paper", paper, PAPERS_DIR))
+    return HTMLResponse(await asyncio.to_thread(mode_messages_html, "paper", paper, PAPERS_DIR))
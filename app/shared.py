@@ -11,16 +11,26 @@ import html as html_lib
 import json
 import subprocess
 import threading
+import weakref
 import time
 import asyncio
-import base64
-import requests
+import functools
+import hashlib
+import os
+import select
+import shutil
+import stat
+import httpx
+import orjson
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 from pathlib import Path
-from urllib.parse import quote
+from urllib.parse import quote, urlparse
 
 from app import db
 from app import config
-from app.config import run_local_command
 
 # File upload
 UPLOAD_DIR = Path(__file__).resolve().parent.parent / "uploads"
@@ -30,28 +40,69 @@ ATTACHMENTS_DIR = config.ATTACHMENTS_DIR
 # MCP server config (populated at runtime by load_mcp_servers())
 MCP_SERVERS = {}
 
+# Code project / MCP server / command names (\Z so a trailing newline is rejected)
+PROJECT_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]+\Z')
+
+# Message placeholders: {{cmd:name}} and {{file:name}}
+CMD_PLACEHOLDER_RE = re.compile(r'\{\{cmd:([a-zA-Z0-9_-]+)\}\}')
+FILE_PLACEHOLDER_RE = re.compile(r'\{\{file:([a-zA-Z0-9._-]+)\}\}')
+
 # Event types sent via SSE
 SSE_EVENT_TYPES = {"init", "tool_use", "edit_result", "read_result", "bash_result", "tool_output", "text", "result"}
 
 
-def _read_sse_response(sse_iter, target_id, timeout_lines=200):
-    """Read and return a response for a specific JSON-RPC id from an SSE stream"""
-    for i, line in enumerate(sse_iter):
-        if i > timeout_lines:
-            break
-        if not line:
-            continue
-        if line.startswith("event:") and "message" in line:
+# Wall-clock budget for one SSE discovery handshake
+SSE_DISCOVERY_TIMEOUT = 15.0
+
+
+async def _iter_sse_events(sse_resp):
+    """Yield (event, data) per SSE frame; frames end at a blank line and multiple data: lines are joined"""
+    buf = b""
+    async for chunk in sse_resp.aiter_bytes():
+        buf = (buf + chunk).replace(b"\r\n", b"\n")
+        while True:
+            idx = buf.find(b"\n\n")
+            if idx == -1:
+                break
+            frame, buf = buf[:idx], buf[idx + 2:]
+            event, data = "message", []
+            for line in frame.decode("utf-8", "replace").split("\n"):
+                if not line or line.startswith(":"):
+                    continue
+                field, _, value = line.partition(":")
+                if value.startswith(" "):
+                    value = value[1:]
+                if field == "event":
+                    event = value
+                elif field == "data":
+                    data.append(value)
+            if data:
+                yield event, "\n".join(data)
+
+
+async def _next_sse_event(events, deadline):
+    """Return the next (event, data) frame, or None when the stream ends or the deadline passes"""
+    remaining = deadline - asyncio.get_running_loop().time()
+    if remaining <= 0:
+        return None
+    try:
+        return await asyncio.wait_for(anext(events), remaining)
+    except (StopAsyncIteration, asyncio.TimeoutError):
+        return None
+
+
+async def _read_sse_response(events, target_id, deadline):
+    """Read and return a response for a specific JSON-RPC id from an SSE event iterator"""
+    while True:
+        frame = await _next_sse_event(events, deadline)
+        if frame is None:
+            return None
+        try:
+            data = json.loads(frame[1])
+        except (json.JSONDecodeError, ValueError):
             continue
-        if line.startswith("data:"):
-            data_str = line[5:].strip()
-            try:
-                data = json.loads(data_str)
-                if data.get("id") == target_id:
-                    return data
-            except (json.JSONDecodeError, ValueError):
-                pass
-    return None
+        if isinstance(data, dict) and data.get("id") == target_id:
+            return data
 
 
 def _extract_tools(tools_result) -> list:
@@ -62,80 +113,74 @@ def _extract_tools(tools_result) -> list:
             for t in tools_result.get("result", {}).get("tools", [])]
 
 
-def discover_mcp_tools_sse(url: str) -> list:
-    """Discover tool list via MCP SSE protocol.
-    SSE transport: open stream with GET, send request with POST, receive response from SSE stream."""
-    from urllib.parse import urlparse
-
-    try:
-        # Open and maintain SSE stream
-        sse_resp = requests.get(url, stream=True, timeout=(10, 15))
-        sse_resp.raise_for_status()
-        sse_iter = sse_resp.iter_lines(decode_unicode=True)
-
-        # Obtain message endpoint from first event
-        message_endpoint = None
-        for line in sse_iter:
-            if not line:
-                continue
-            if line.startswith("data:"):
-                data = line[5:].strip()
-                if data.startswith("/") or data.startswith("http"):
+async def _discover_mcp_tools_sse_async(url: str) -> list:
+    """SSE transport: open stream with GET, send requests with POST, receive responses from the SSE stream.
+    POSTs run as tasks on the same loop and client (keep-alive), overlapping with the stream read."""
+
+    async with httpx.AsyncClient(timeout=httpx.Timeout(15, connect=10)) as client:
+        async with client.stream("GET", url) as sse_resp:
+            sse_resp.raise_for_status()
+            events = _iter_sse_events(sse_resp)
+            deadline = asyncio.get_running_loop().time() + SSE_DISCOVERY_TIMEOUT
+
+            # Obtain message endpoint from first event
+            message_endpoint = None
+            while message_endpoint is None:
+                frame = await _next_sse_event(events, deadline)
+                if frame is None:
+                    return []
+                data = frame[1].strip()
+                if frame[0] == "endpoint" or data.startswith("/") or data.startswith("http"):
                     message_endpoint = data
-                    break
 
-        if not message_endpoint:
-            sse_resp.close()
-            return []
+            # Construct absolute URL
+            if message_endpoint.startswith("/"):
+                parsed = urlparse(url)
+                message_endpoint = f"{parsed.scheme}://{parsed.netloc}{message_endpoint}"
 
-        # Construct absolute URL
-        if message_endpoint.startswith("/"):
-            parsed = urlparse(url)
-            message_endpoint = f"{parsed.scheme}://{parsed.netloc}{message_endpoint}"
-
-        def post_async(endpoint, payload):
-            """Send POST in a separate thread (parallel with SSE reading)"""
-            t = threading.Thread(target=lambda: requests.post(endpoint, json=payload, timeout=10))
-            t.daemon = True
-            t.start()
-            return t
-
-        # initialize: send POST request and wait for response from SSE
-        post_async(message_endpoint, {
-            "jsonrpc": "2.0",
-            "id": 1,
-            "method": "initialize",
-            "params": {
-                "protocolVersion": "2024-11-05",
-                "capabilities": {},
-                "clientInfo": {"name": "ddoli", "version": "1.0.0"}
-            }
-        })
-
-        init_result = _read_sse_response(sse_iter, 1)
-        if not init_result:
-            sse_resp.close()
-            return []
-
-        # initialized notification
-        requests.post(message_endpoint, json={
-            "jsonrpc": "2.0",
-            "method": "notifications/initialized",
-            "params": {}
-        }, timeout=10)
-
-        # tools/list: send POST request and wait for response from SSE
-        post_async(message_endpoint, {
-            "jsonrpc": "2.0",
-            "id": 2,
-            "method": "tools/list",
-            "params": {}
-        })
+            async def request(payload):
+                """POST a request and wait for its response on the SSE stream"""
+                post = asyncio.create_task(client.post(message_endpoint, json=payload, timeout=10))
+                try:
+                    return await _read_sse_response(events, payload["id"], deadline)
+                finally:
+                    if not post.done():
+                        post.cancel()
+                    await asyncio.gather(post, return_exceptions=True)
+
+            init_result = await request({
+                "jsonrpc": "2.0",
+                "id": 1,
+                "method": "initialize",
+                "params": {
+                    "protocolVersion": "2024-11-05",
+                    "capabilities": {},
+                    "clientInfo": {"name": "ddoli", "version": "1.0.0"}
+                }
+            })
+            if not init_result:
+                return []
+
+            # initialized notification
+            await client.post(message_endpoint, json={
+                "jsonrpc": "2.0",
+                "method": "notifications/initialized",
+                "params": {}
+            }, timeout=10)
+
+            tools_result = await request({
+                "jsonrpc": "2.0",
+                "id": 2,
+                "method": "tools/list",
+                "params": {}
+            })
+            return _extract_tools(tools_result)
 
-        tools_result = _read_sse_response(sse_iter, 2)
-        sse_resp.close()
-        return _extract_tools(tools_result)
 
+def discover_mcp_tools_sse(url: str) -> list:
+    """Discover tool list via MCP SSE protocol (sync wrapper; called from worker threads)"""
+    try:
+        return asyncio.run(_discover_mcp_tools_sse_async(url))
     except Exception:
         return []
 
@@ -158,32 +203,37 @@ def discover_mcp_tools_stdio(command: str, args: list) -> list:
             process.stdin.write(data + "\n")
             process.stdin.flush()
 
+        # Read the raw fd so select() sees every pending byte; complete lines are
+        # consumed from a rolling buffer and each is parsed exactly once
+        out_fd = process.stdout.fileno()
+        pending = bytearray()
+
         def read_jsonrpc(target_id, timeout=15):
-            import select
             deadline = time.time() + timeout
-            buf = ""
-            while time.time() < deadline:
-                remaining = deadline - time.time()
-                ready, _, _ = select.select([process.stdout], [], [], min(remaining, 0.5))
-                if not ready:
-                    continue
-                chunk = process.stdout.readline()
-                if not chunk:
-                    break
-                buf += chunk
-                # JSON-RPC responses are line-delimited
-                for line in buf.strip().split("\n"):
-                    line = line.strip()
+            while True:
+                nl = pending.find(b"\n")
+                if nl != -1:
+                    line = bytes(pending[:nl]).strip()
+                    del pending[:nl + 1]
                     if not line:
                         continue
                     try:
                         data = json.loads(line)
                         if data.get("id") == target_id:
                             return data
-                    except (json.JSONDecodeError, ValueError):
-                        continue
-                buf = ""
-            return None
+                    except (json.JSONDecodeError, ValueError, AttributeError):
+                        pass
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                ready, _, _ = select.select([out_fd], [], [], remaining)
+                if not ready:
+                    return None
+                chunk = os.read(out_fd, 65536)
+                if not chunk:
+                    return None
+                pending.extend(chunk)
 
         # initialize
         send_jsonrpc({
@@ -235,13 +285,14 @@ def load_mcp_servers():
             MCP_SERVERS.clear()
             for key, srv in saved.items():
                 MCP_SERVERS[key] = {**srv, "tools": []}
+            _mcp_changed()
             return
         except (json.JSONDecodeError, ValueError):
             pass
     # If not in DB, use defaults and save to DB
     MCP_SERVERS.clear()
     for key, srv in config.DEFAULT_MCP_SERVERS.items():
-        MCP_SERVERS[key] = {**srv, "tools": []}
+        MCP_SERVERS[key] = {**config.mcp_server_copy(srv), "tools": []}
     save_mcp_servers()
 
 
@@ -251,10 +302,71 @@ def save_mcp_servers():
     for name, srv in MCP_SERVERS.items():
         to_save[name] = {k: v for k, v in srv.items() if k != "tools"}
     db.set_setting("mcp_servers", json.dumps(to_save, ensure_ascii=False))
+    _mcp_changed()
+
+
+# Bumped on every MCP_SERVERS change (config or discovered tools); part of the build_mcp_flags cache key
+_mcp_version = 0
+
+
+def _mcp_changed():
+    """Invalidate build_mcp_flags results derived from the previous MCP_SERVERS state"""
+    global _mcp_version
+    _mcp_version += 1
+
+
+# Discovered tool lists persisted in settings["mcp_tools_cache"]: {config_key: {"tools": [...], "ts": epoch}}
+MCP_TOOLS_CACHE_TTL = 3600.0
+MCP_DISCOVERY_WORKERS = 16
+_mcp_tools_cache_lock = threading.Lock()
+
+
+def _mcp_tools_cache_key(server: dict) -> str:
+    """Signature of the connection-relevant server config (changes to it miss the cache)"""
+    sig = {k: server.get(k) for k in ("type", "url", "command", "args")}
+    return hashlib.sha256(json.dumps(sig, sort_keys=True).encode()).hexdigest()
 
 
-def _discover_server_tools(name, server):
-    """Discover tools for a single MCP server"""
+def _load_mcp_tools_cache() -> dict:
+    """Read the persisted MCP tool cache ({} if missing or unreadable)"""
+    raw = db.get_setting("mcp_tools_cache")
+    if raw:
+        try:
+            cache = json.loads(raw)
+            if isinstance(cache, dict):
+                return cache
+        except (json.JSONDecodeError, ValueError):
+            pass
+    return {}
+
+
+def _update_mcp_tools_cache(key: str = None, tools: list = None):
+    """Store one cache entry (if given) and prune entries no registered server maps to"""
+    with _mcp_tools_cache_lock:
+        cache = _load_mcp_tools_cache()
+        if key is not None:
+            cache[key] = {"tools": tools, "ts": time.time()}
+        live = {_mcp_tools_cache_key(srv) for srv in list(MCP_SERVERS.values())}
+        cache = {k: v for k, v in cache.items() if k in live}
+        db.set_setting("mcp_tools_cache", json.dumps(cache, ensure_ascii=False))
+
+
+def _discover_server_tools(name, server, force_refresh: bool = False):
+    """Discover tools for a single MCP server (served from the persistent cache while fresh)"""
+    key = _mcp_tools_cache_key(server)
+    if not force_refresh:
+        entry = _load_mcp_tools_cache().get(key)
+        if entry and time.time() - entry.get("ts", 0) < MCP_TOOLS_CACHE_TTL:
+            return entry.get("tools", [])
+    tools = _discover_server_tools_uncached(server)
+    # Failed/empty discoveries are not cached so an unreachable server is retried next time
+    if tools:
+        _update_mcp_tools_cache(key, tools)
+    return tools
+
+
+def _discover_server_tools_uncached(server):
+    """Run the MCP handshake for a single server"""
     server_type = server.get("type", "sse")
     if server_type == "sse":
         return discover_mcp_tools_sse(server["url"])
@@ -271,8 +383,10 @@ def _upsert_mcp_server(name: str, server_config: dict) -> tuple[bool, str]:
     server = {**server_config, "tools": []}
     MCP_SERVERS[name] = server
     save_mcp_servers()
-    tools = _discover_server_tools(name, server)
+    # Saving a server is an explicit request to (re)connect, so bypass the cache
+    tools = _discover_server_tools(name, server, force_refresh=True)
     server["tools"] = tools
+    _mcp_changed()
     return True, f"{len(tools)} tools discovered"
 
 
@@ -296,23 +410,49 @@ def remove_mcp_server(name: str) -> tuple[bool, str]:
         return False, f"Server '{name}' not found."
     del MCP_SERVERS[name]
     save_mcp_servers()
+    _update_mcp_tools_cache()
     return True, "Deleted"
 
 
+def refresh_mcp_server(name: str) -> tuple[bool, str]:
+    """Rediscover tools for one MCP server, bypassing the cache. Returns (success, message)."""
+    server = MCP_SERVERS.get(name)
+    if server is None:
+        return False, f"Server '{name}' not found."
+    tools = _discover_server_tools(name, server, force_refresh=True)
+    server["tools"] = tools
+    _mcp_changed()
+    return True, f"{len(tools)} tools discovered"
+
+
 def init_mcp_servers():
     """Load servers from DB and auto-discover tools from all MCP servers"""
     load_mcp_servers()
-    for name, server in MCP_SERVERS.items():
-        tools = _discover_server_tools(name, server)
-        server["tools"] = tools
+    servers = list(MCP_SERVERS.items())
+    if not servers:
+        return
+    # Discovery is network/subprocess wait, so run the servers concurrently (each worker fills its own dict)
+    with ThreadPoolExecutor(max_workers=min(MCP_DISCOVERY_WORKERS, len(servers))) as pool:
+        futures = {pool.submit(_discover_server_tools, name, server): server for name, server in servers}
+        for future in as_completed(futures):
+            try:
+                futures[future]["tools"] = future.result()
+            except Exception:
+                futures[future]["tools"] = []
+    _mcp_changed()
 
 
-def build_mcp_flags(enabled_tools: list, mode: str = "") -> str:
-    """Build MCP flag string from list of enabled tools.
+def build_mcp_flags(enabled_tools: list, mode: str = "") -> list:
+    """Build MCP CLI arguments (argv list) from list of enabled tools.
     Explicitly specify MCP servers via --mcp-config (supports both SSE/stdio),
     disallow all MCP tools if enabled_tools is empty.
     If mode is specified, only include servers that support that mode."""
+    return list(_build_mcp_flags_cached(frozenset(enabled_tools), mode, _mcp_version))
+
 
+@functools.lru_cache(maxsize=128)
+def _build_mcp_flags_cached(enabled_tools: frozenset, mode: str, version: int) -> tuple:
+    """build_mcp_flags body; version pins the result to one MCP_SERVERS state"""
     flags = []
     all_mcp_tools = []
 
@@ -323,12 +463,10 @@ def build_mcp_flags(enabled_tools: list, mode: str = "") -> str:
         server_type = server.get("type", "sse")
         if server_type == "sse" and server.get("url"):
             config_obj = {"mcpServers": {server_name: {"type": "sse", "url": server["url"]}}}
-            config_json = json.dumps(config_obj, ensure_ascii=False)
-            flags.append(f"--mcp-config '{config_json}'")
+            flags += ["--mcp-config", json.dumps(config_obj, ensure_ascii=False)]
         elif server_type == "stdio" and server.get("command"):
             config_obj = {"mcpServers": {server_name: {"type": "stdio", "command": server["command"], "args": server.get("args", [])}}}
-            config_json = json.dumps(config_obj, ensure_ascii=False)
-            flags.append(f"--mcp-config '{config_json}'")
+            flags += ["--mcp-config", json.dumps(config_obj, ensure_ascii=False)]
 
         for tool in server["tools"]:
             all_mcp_tools.append(f"mcp__{server_name}__{tool['name']}")
@@ -346,10 +484,9 @@ def build_mcp_flags(enabled_tools: list, mode: str = "") -> str:
     disabled.append("AskUserQuestion")
 
     if disabled:
-        disabled_str = " ".join(disabled)
-        flags.append(f"--disallowedTools {disabled_str}")
+        flags += ["--disallowedTools", *disabled]
 
-    return " ".join(flags)
+    return tuple(flags)
 
 
 def calc_context_percent(data: dict) -> float:
@@ -378,32 +515,64 @@ def calc_context_percent(data: dict) -> float:
     return 0
 
 
-def build_local_command(cli_cmd: str) -> list:
-    """Build local shell command"""
-    return ["bash", "-c", cli_cmd]
+# CLI stdout reading: max JSON line size (tool results can be large) and cancel-check interval
+CLI_STREAM_LIMIT = 64 * 1024 * 1024
+CLI_READ_POLL_INTERVAL = 0.5
+
+# Events kept per response for SSE resume / status replay
+EVENT_LOG_MAXLEN = 4096
 
+# SSE readers are woken by EventLog.notify(); this is only the fallback re-check interval
+SSE_IDLE_WAKEUP = 1.0
+SSE_PING_INTERVAL = 15
 
-def parse_cli_stream(process, is_cancelled_fn, events_list, on_text=None, on_result=None) -> str:
-    """Parse CLI stdout JSON stream. Append events to events_list. Return final response text.
+# Events persisted with Code/Paper assistant messages
+MODE_PERSIST_EVENTS = {"text", "tool_use", "edit_result", "bash_result"}
+
+# Max responses kept per mode for status/resume (running responses are never evicted)
+RESPONSES_MAX_ENTRIES = 1024
+
+# Strong references to running generation tasks (the loop only keeps weak ones)
+_background_tasks = set()
+
+
+def start_background_task(coro):
+    """Schedule a coroutine on the running event loop and keep it referenced until done"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def parse_cli_stream(process, is_cancelled_fn, events_list, on_text=None, on_result=None) -> str:
+    """Parse CLI stdout JSON stream (asyncio subprocess). Append events to events_list. Return final response text.
 
     on_text(text, full_response): called on text events
     on_result(data, full_response): called on result events (not directly added to events_list)
     """
-    pending_tools = []
+    pending_tools = deque()
     full_response = ""
     last_assistant_usage = {}
 
     while True:
         if is_cancelled_fn():
-            process.terminate()
-            process.wait(timeout=5)
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(process.wait(), 5)
+            except asyncio.TimeoutError:
+                process.kill()
             break
 
-        line = process.stdout.readline()
-        if not line:
-            if process.poll() is not None:
-                break
+        try:
+            # Wake up periodically so cancellation is noticed while the CLI is quiet
+            line = await asyncio.wait_for(process.stdout.readline(), CLI_READ_POLL_INTERVAL)
+        except asyncio.TimeoutError:
             continue
+        if not line:
+            break
 
         line = line.strip()
         if not line:
@@ -441,7 +610,7 @@ def parse_cli_stream(process, is_cancelled_fn, events_list, on_text=None, on_res
             elif event_type == "user":
                 tool_result = data.get("tool_use_result")
                 if tool_result:
-                    tool_info = pending_tools.pop(0) if pending_tools else {}
+                    tool_info = pending_tools.popleft() if pending_tools else {}
                     evt = process_tool_result(tool_result, tool_info)
                     if evt:
                         events_list.append(evt)
@@ -458,22 +627,24 @@ def parse_cli_stream(process, is_cancelled_fn, events_list, on_text=None, on_res
         except json.JSONDecodeError:
             pass
 
-    process.wait()
+    await process.wait()
     return full_response
 
 
 def replace_command_placeholders(text: str) -> str:
     """Replace {{cmd:xxx}} patterns with actual command content"""
-    pattern = r'\{\{cmd:([a-zA-Z0-9_-]+)\}\}'
+    names = set(CMD_PLACEHOLDER_RE.findall(text))
+    if not names:
+        return text
+    cmds = db.get_commands_by_names(names)
     def replacer(match):
-        cmd = db.get_command_by_name(match.group(1))
+        cmd = cmds.get(match.group(1))
         return cmd["content"] if cmd else match.group(0)
-    return re.sub(pattern, replacer, text)
+    return CMD_PLACEHOLDER_RE.sub(replacer, text)
 
 
 def copy_upload_file(local_path: str, dest_path: str) -> tuple[bool, str]:
     """Copy file to local attachments directory"""
-    import shutil
     try:
         dest = Path(dest_path)
         dest.parent.mkdir(parents=True, exist_ok=True)
@@ -486,12 +657,11 @@ def copy_upload_file(local_path: str, dest_path: str) -> tuple[bool, str]:
 def replace_file_placeholders(text: str, file_map: dict = None) -> str:
     """Detect {{file:xxx}} patterns, copy to attachments directory, and replace with info message.
     file_map: {shortName: saveName} mapping (e.g., {"image1": "abc12345_photo.jpg"})"""
+    if "{{file:" not in text:
+        return text
     if not file_map:
         file_map = {}
-    pattern = r'\{\{file:([a-zA-Z0-9._-]+)\}\}'
-    # Create directory only when file placeholders exist (once)
-    if re.search(pattern, text):
-        Path(ATTACHMENTS_DIR).mkdir(parents=True, exist_ok=True)
+    # Single pass; copy_upload_file creates the attachments directory on first copy
     def replacer(match):
         short_name = match.group(1)
         save_name = file_map.get(short_name, short_name)
@@ -504,7 +674,7 @@ def replace_file_placeholders(text: str, file_map: dict = None) -> str:
             local_path.unlink(missing_ok=True)
             return f"\n[Attachment: {dest_path}]\n"
         return f"[File transfer failed: {err}]"
-    return re.sub(pattern, replacer, text)
+    return FILE_PLACEHOLDER_RE.sub(replacer, text)
 
 
 def process_tool_result(tool_result, tool_info):
@@ -542,7 +712,7 @@ def render_user_message_html(content: str, include_script: bool = True) -> str:
     msg_id = str(uuid.uuid4())[:8]
     # Display {{file:xxx}} patterns as file badges (for history)
     display_content = content
-    display_content = re.sub(r'\{\{file:([a-zA-Z0-9._-]+)\}\}', r'📎 \1', display_content)
+    display_content = FILE_PLACEHOLDER_RE.sub(r'📎 \1', display_content)
     escaped = html_lib.escape(display_content).replace('\n', '<br>')
     html = f'''<div class="flex justify-end mb-4">
         <div class="relative max-w-[85%]">
@@ -588,6 +758,14 @@ def _get_tool_icon_title(tool_name: str, tool_input: dict) -> tuple[str, str, st
     return icon, title, detail
 
 
+# Removed/added diff line wrappers for edit_result cards
+_DIFF_LINE_PRE = {
+    "-": '<div class="bg-red-100 text-red-700 px-2 font-mono text-xs">',
+    "+": '<div class="bg-green-100 text-green-700 px-2 font-mono text-xs">',
+}
+_DIFF_LINE_SUF = '</div>'
+
+
 def render_tool_events_html(events: list) -> str:
     """Render tool events list as HTML"""
     if not events:
@@ -613,8 +791,16 @@ def render_tool_events_html(events: list) -> str:
             parts.append(_tool_card(icon, title, "text-claude-accent", "Done", _detail_pre(detail)))
         elif t == "edit_result":
             fn = html_lib.escape(d.get("filePath", "").split("/")[-1]) if d.get("filePath") else ""
-            diff = "".join(f'<div class="bg-{"red" if l.startswith("-") else "green"}-100 text-{"red" if l.startswith("-") else "green"}-700 px-2 font-mono text-xs">{html_lib.escape(l)}</div>' for p in d.get("patch", []) for l in p.get("lines", []) if l.startswith(("-", "+")))
-            parts.append(f'<div class="bg-white rounded-lg overflow-hidden border border-claude-accent mb-2"><div class="px-3 py-2 bg-claude-accent/5 flex items-center gap-2">{_svg_icon("text-claude-accent", "M5 13l4 4L19 7")}<span class="text-sm text-claude-text">File modified</span><span class="text-xs text-claude-text-secondary">{fn}</span></div><div class="max-h-32 overflow-y-auto">{diff}</div></div>')
+            parts.append(f'<div class="bg-white rounded-lg overflow-hidden border border-claude-accent mb-2"><div class="px-3 py-2 bg-claude-accent/5 flex items-center gap-2">{_svg_icon("text-claude-accent", "M5 13l4 4L19 7")}<span class="text-sm text-claude-text">File modified</span><span class="text-xs text-claude-text-secondary">{fn}</span></div><div class="max-h-32 overflow-y-auto">')
+            # Diff lines go straight into parts: no per-line f-string or nested join
+            for p in d.get("patch", []):
+                for l in p.get("lines", []):
+                    pre = _DIFF_LINE_PRE.get(l[:1])
+                    if pre:
+                        parts.append(pre)
+                        parts.append(html_lib.escape(l))
+                        parts.append(_DIFF_LINE_SUF)
+            parts.append('</div></div>')
         elif t == "bash_result":
             cmd, output = d.get("command", ""), d.get("stdout", "") or d.get("stderr", "")
             err = d.get("exitCode", 0) != 0 or d.get("stderr", "")
@@ -634,6 +820,27 @@ def render_tool_events_html(events: list) -> str:
 
 # ========== Code/Paper mode common functions ==========
 
+# Per-(mode, project name) locks for clone/rename/delete (dropped when no request holds them)
+_project_name_locks: "weakref.WeakValueDictionary[tuple, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+@asynccontextmanager
+async def project_locks(mode: str, *names: str):
+    """Hold the locks for the given project names of a mode (acquired in sorted order to avoid deadlock)"""
+    locks = []
+    for name in sorted(set(names)):
+        key = (mode, name)
+        lock = _project_name_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            _project_name_locks[key] = lock
+        locks.append(lock)
+    async with AsyncExitStack() as stack:
+        for lock in locks:
+            await stack.enter_async_context(lock)
+        yield
+
+
 def parse_file_map(file_map: str) -> dict:
     """Parse file mapping string to dict (shortName:saveName,...)"""
     fmap = {}
@@ -645,6 +852,69 @@ def parse_file_map(file_map: str) -> dict:
     return fmap
 
 
+class EventLog:
+    """Per-response CLI event log with absolute indices and a bounded replay window.
+    Events whose type is in keep (all if None) are also retained in full for the DB save."""
+
+    def __init__(self, keep: set = None, maxlen: int = EVENT_LOG_MAXLEN):
+        self._events = deque(maxlen=maxlen)
+        self._keep = keep
+        self.kept = []
+        self.next_idx = 0
+        self._changed = asyncio.Event()
+
+    def append(self, evt: dict):
+        self._events.append(evt)
+        self.next_idx += 1
+        if self._keep is None or evt.get("type") in self._keep:
+            self.kept.append(evt)
+        self.notify()
+
+    def changed(self) -> asyncio.Event:
+        """Event set on the next append/notify (grab it before reading, then await it)"""
+        return self._changed
+
+    def notify(self):
+        """Wake SSE readers (event loop only; use loop.call_soon_threadsafe from threads)"""
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def base_idx(self) -> int:
+        """Absolute index of the oldest event still in the window"""
+        return self.next_idx - len(self._events)
+
+    def since(self, idx: int) -> tuple[int, list]:
+        """Events from absolute index idx onward (clamped to the window). Returns (start_idx, events)"""
+        base = self.base_idx
+        start = max(idx, base)
+        return start, list(islice(self._events, start - base, None))
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def __len__(self):
+        return len(self._events)
+
+
+class BoundedResponses(OrderedDict):
+    """In-memory response registry capped at max_entries (evicts the oldest finished responses first)"""
+
+    def __init__(self, max_entries: int = RESPONSES_MAX_ENTRIES):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.max_entries:
+            for rid in list(self):
+                if len(self) <= self.max_entries:
+                    break
+                if self[rid].get("status") in ("completed", "error"):
+                    del self[rid]
+
+
 def cleanup_old_responses(responses: dict):
     """Clean up old completed responses (older than 10 minutes)"""
     now = time.time()
@@ -666,36 +936,37 @@ def get_or_create_mode_session(mode: str, name: str, get_messages_fn) -> tuple[s
     return session_id, is_first, cli_session_id
 
 
-def run_mode_generation(response_id: str, mode: str, name: str, message: str,
-                        is_first_message: bool, cli_session_id: str, mcp_tools: str,
-                        work_dir: str, responses: dict, streams: dict,
-                        get_session_lock, update_context_fn, add_message_fn,
-                        model: str = "sonnet", mode_opts: dict = None):
-    """Run Claude CLI in background (common for chat/code/paper)
+async def run_mode_generation(response_id: str, mode: str, name: str, message: str,
+                              is_first_message: bool, cli_session_id: str, mcp_tools: str,
+                              work_dir: str, responses: dict, streams: dict,
+                              get_session_lock, update_context_fn, add_message_fn,
+                              model: str = "sonnet", mode_opts: dict = None):
+    """Run Claude CLI as a background task on the event loop (common for chat/code/paper)
 
     mode_opts (optional):
         lock_key: lock key (default: f"{mode}_{name}")
-        extra_cli_flags: additional CLI flags (e.g., --system-prompt, --tools)
+        extra_cli_flags: additional CLI arguments as an argv list (e.g., ["--system-prompt", prompt])
         status_running: running status name (default: "running")
         on_first_message: first message hook callable(response_id, message)
         work_dir_suffix: working directory suffix (None->/{name}, ""->none)
         on_text: text event hook callable(text, full_response)
-        event_filter: event filter set for DB save (None->save all)
     """
     opts = mode_opts or {}
     lock_key = opts.get("lock_key", f"{mode}_{name}")
     lock = get_session_lock(lock_key)
-    if not lock.acquire(timeout=120):
+    try:
+        await asyncio.wait_for(lock.acquire(), 120)
+    except asyncio.TimeoutError:
         responses[response_id]["status"] = "error"
         responses[response_id]["error"] = "Previous response is still processing."
+        responses[response_id]["events"].notify()
         streams.pop(response_id, None)
         return
 
-    escaped_message = message.replace("'", "'\"'\"'")
-    session_flag = f"--session-id '{cli_session_id}'" if is_first_message else f"--resume '{cli_session_id}'"
+    session_flag = "--session-id" if is_first_message else "--resume"
     enabled = [t.strip() for t in mcp_tools.split(",") if t.strip()] if mcp_tools else []
     mcp_flags = build_mcp_flags(enabled, mode=mode)
-    extra_flags = opts.get("extra_cli_flags", "")
+    extra_flags = opts.get("extra_cli_flags", [])
 
     # Determine working directory
     suffix = opts.get("work_dir_suffix")
@@ -704,7 +975,9 @@ def run_mode_generation(response_id: str, mode: str, name: str, message: str,
     else:
         dir_part = f"{work_dir}/{name}"
 
-    cli_cmd = f"cd {dir_part} && echo '{escaped_message}' | claude -p --output-format stream-json --verbose --dangerously-skip-permissions --model {model} {session_flag} {extra_flags} {mcp_flags}"
+    # argv without a shell: the message goes over stdin, so no quoting/escaping is involved
+    cli_argv = ["claude", "-p", "--output-format", "stream-json", "--verbose", "--dangerously-skip-permissions",
+                "--model", model, session_flag, cli_session_id, *extra_flags, *mcp_flags]
 
     try:
         # First message hook (e.g., chat title generation)
@@ -718,15 +991,24 @@ def run_mode_generation(response_id: str, mode: str, name: str, message: str,
 
         status_running = opts.get("status_running", "running")
         responses[response_id]["status"] = status_running
-
-        process = subprocess.Popen(
-            build_local_command(cli_cmd),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1
+        responses[response_id]["events"].notify()
+
+        process = await asyncio.create_subprocess_exec(
+            *cli_argv,
+            cwd=dir_part,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=CLI_STREAM_LIMIT
         )
         streams[response_id]["process"] = process
+        # claude -p reads the whole prompt from stdin before producing output
+        process.stdin.write(message.encode() + b"\n")
+        try:
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        process.stdin.close()
         resp = responses[response_id]
 
         def on_result(data, full):
@@ -739,10 +1021,10 @@ def run_mode_generation(response_id: str, mode: str, name: str, message: str,
                 "data": {"text": data.get("result", ""), "contextPercent": context_percent}
             })
             if context_percent > 0:
-                update_context_fn(name, context_percent)
+                start_background_task(asyncio.to_thread(update_context_fn, name, context_percent))
 
         on_text = opts.get("on_text")
-        final_result = parse_cli_stream(
+        final_result = await parse_cli_stream(
             process,
             lambda: resp.get("cancelled", False),
             resp["events"],
@@ -750,14 +1032,10 @@ def run_mode_generation(response_id: str, mode: str, name: str, message: str,
             on_result=on_result
         )
 
-        # Save to DB
-        event_filter = opts.get("event_filter")
-        if event_filter:
-            collected_events = [evt for evt in resp["events"] if evt.get("type") in event_filter]
-        else:
-            collected_events = resp["events"]
+        # Save to DB (events selected by the log's keep filter)
+        collected_events = resp["events"].kept
         if not resp.get("cancelled") and (final_result or collected_events):
-            add_message_fn(name, "assistant", final_result, collected_events if collected_events else None)
+            await asyncio.to_thread(add_message_fn, name, "assistant", final_result, collected_events if collected_events else None)
 
         resp["status"] = "completed"
 
@@ -767,17 +1045,27 @@ def run_mode_generation(response_id: str, mode: str, name: str, message: str,
     finally:
         streams.pop(response_id, None)
         lock.release()
+        if response_id in responses:
+            responses[response_id]["events"].notify()
 
 
 async def mode_stream_sse(id: str, responses: dict, streams: dict, start_from: int = 0,
-                          extra_events_fn=None, done_data_fn=None):
+                          extra_events_fn=None, done_data_fn=None, request=None):
     """SSE streaming generator (common for chat/code/paper)
 
     extra_events_fn: callable(resp) -> list[dict] - additional SSE events (chat: title, session_id, status)
     done_data_fn: callable(resp) -> str - done event data (chat: message_id)
+    request: if given, the generator stops as soon as the client disconnects.
+        Only the reader stops; the CLI keeps running so the reply is still saved and can be resumed.
+        Its Last-Event-ID header (sent by EventSource on auto-reconnect) also advances start_from.
     """
     from sse_starlette.sse import EventSourceResponse
 
+    if request is not None:
+        last_id = request.headers.get("last-event-id", "")
+        if last_id.isdigit():
+            start_from = max(start_from, int(last_id) + 1)
+
     async def generate():
         if id not in responses:
             yield {"event": "error_msg", "data": "Session not found."}
@@ -785,9 +1073,11 @@ async def mode_stream_sse(id: str, responses: dict, streams: dict, start_from: i
             return
 
         resp = responses[id]
+        log = resp["events"]
         last_event_idx = max(0, start_from)
 
         while True:
+            changed = log.changed()
             if streams.get(id, {}).get("cancelled"):
                 responses[id]["cancelled"] = True
                 yield {"event": "done", "data": ""}
@@ -800,16 +1090,17 @@ async def mode_stream_sse(id: str, responses: dict, streams: dict, start_from: i
                 for extra_evt in extra_events_fn(resp):
                     yield extra_evt
 
-            # Send tool events
-            events = resp.get("events", [])
-            while last_event_idx < len(events):
-                evt = events[last_event_idx]
+            # Send only events appended since the last flush
+            start, new_events = log.since(last_event_idx)
+            for idx, evt in enumerate(new_events, start):
                 evt_type = evt.get("type", "")
-                evt_data = evt.get("data", {})
                 if evt_type in SSE_EVENT_TYPES:
-                    evt_data_with_idx = {**evt_data, "_idx": last_event_idx}
-                    yield {"event": evt_type, "data": json.dumps(evt_data_with_idx)}
-                last_event_idx += 1
+                    evt_data_with_idx = {**evt.get("data", {}), "_idx": idx}
+                    yield {"event": evt_type, "data": orjson.dumps(evt_data_with_idx).decode(), "id": str(idx)}
+                    if len(new_events) > 1:
+                        # Let the server drain each event of a burst instead of flushing them together
+                        await asyncio.sleep(0)
+            last_event_idx = start + len(new_events)
 
             if status == "completed":
                 done_data = done_data_fn(resp) if done_data_fn else ""
@@ -820,9 +1111,15 @@ async def mode_stream_sse(id: str, responses: dict, streams: dict, start_from: i
                 yield {"event": "done", "data": ""}
                 return
 
-            await asyncio.sleep(0.05)
+            # Push: sleep until the producer appends/notifies (fallback re-check for cancel flags / disconnect)
+            try:
+                await asyncio.wait_for(changed.wait(), SSE_IDLE_WAKEUP)
+            except asyncio.TimeoutError:
+                if request is not None and await request.is_disconnected():
+                    return
 
-    return EventSourceResponse(generate())
+    # Comment pings keep proxies from closing the stream during long tool runs
+    return EventSourceResponse(generate(), ping=SSE_PING_INTERVAL)
 
 
 def mode_status_response(response_id: str, responses: dict, item_key: str,
@@ -834,7 +1131,8 @@ def mode_status_response(response_id: str, responses: dict, item_key: str,
     resp = responses[response_id]
     result = {
         "status": resp.get("status", "unknown"),
-        "events": resp.get("events", []),
+        "events": list(resp["events"]),
+        "next_idx": resp["events"].next_idx,
         "final_result": resp.get("final_result", ""),
         "context_percent": resp.get("context_percent", 0),
         "error": resp.get("error"),
@@ -856,6 +1154,30 @@ def mode_active_response(responses: dict, item_key: str, item_value: str,
     return {"active": active}
 
 
+def mode_cancel_response(response_id: str, responses: dict, streams: dict) -> dict:
+    """Stop one in-flight response: flag it, terminate its CLI process and wake its SSE readers"""
+    stream = streams.get(response_id)
+    resp = responses.get(response_id)
+    if not stream and not (resp and resp.get("status") in ("pending", "running")):
+        return {"cancelled": False}
+    if stream:
+        stream["cancelled"] = True
+        process = stream.get("process")
+        if process and process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+    if resp:
+        resp["cancelled"] = True
+        resp["events"].notify()
+    return {"cancelled": True}
+
+
+# Editor limits for file-content / file-write
+FILE_CONTENT_MAX_LINES = 1000
+FILE_WRITE_MAX_CHARS = 10 * 1024 * 1024
+
 MEDIA_EXTENSIONS = {
     'image': {'jpg', 'jpeg', 'png', 'gif', 'webp', 'svg', 'bmp', 'ico', 'heic', 'heif'},
     'video': {'mp4', 'webm', 'mov', 'ogg'},
@@ -881,201 +1203,319 @@ def _get_media_type(path: str):
     return None, None
 
 
-def _shell_quote_path(base_dir: str, name: str, path: str) -> str:
-    """Safely wrap shell path in single quotes (handles unicode/spaces, preserves ~ expansion)"""
-    full = f"{base_dir}/{name}/{path}"
-    # ~ must be outside quotes for shell to expand to home directory
-    if full.startswith("~/"):
-        rest = full[2:].replace("'", "'\"'\"'")
-        return "~/" + "'" + rest + "'"
-    return "'" + full.replace("'", "'\"'\"'") + "'"
+def _project_path(base_dir: str, name: str, path: str = ""):
+    """Absolute filesystem path of a file inside a project (for argv / in-process use).
+    Returns None if name is not a plain directory name or the result resolves outside base_dir"""
+    if not name or os.sep in name or "\0" in name or "\0" in path or name in (".", ".."):
+        return None
+    base = os.path.expanduser(base_dir)
+    full = os.path.join(base, name, path.lstrip("/"))
+    if not os.path.realpath(full).startswith(os.path.realpath(base) + os.sep):
+        return None
+    return full
+
+
+def _bad_file_path(path: str) -> bool:
+    """True for a file path that is not a plain project-relative path (shared by read/write/serve)"""
+    return ".." in path or path.startswith("/")
 
 
 def mode_file_content(base_dir: str, name: str, path: str):
-    """Get file content (common for Code/Paper)"""
+    """Get file content, first FILE_CONTENT_MAX_LINES lines (common for Code/Paper)"""
     if not name or not path:
         return {"error": "Project and path are required."}
-    if ".." in path:
+    if _bad_file_path(path):
+        return {"error": "Invalid path."}
+    full = _project_path(base_dir, name, path)
+    if full is None:
         return {"error": "Invalid path."}
-    safe = _shell_quote_path(base_dir, name, path)
-    success, output = run_local_command(f"cat {safe} 2>&1 | head -1000")
-    if not success:
-        return {"error": output or "Cannot read file."}
-    return {"content": output, "path": path}
+    try:
+        with open(full, encoding="utf-8", errors="replace") as f:
+            content = "".join(islice(f, FILE_CONTENT_MAX_LINES))
+    except OSError as e:
+        return {"error": e.strerror or "Cannot read file."}
+    return {"content": content, "path": path}
 
 
 def mode_file_write(base_dir: str, name: str, path: str, content: str):
     """Save file content (common for Code/Paper)"""
     if not name or not path:
         return {"error": "Project and path are required."}
-    if ".." in path or path.startswith("/"):
+    if _bad_file_path(path):
+        return {"error": "Invalid path."}
+    if len(content) > FILE_WRITE_MAX_CHARS:
+        return {"error": "File too large to save."}
+    full = _project_path(base_dir, name, path)
+    if full is None:
         return {"error": "Invalid path."}
-    safe = _shell_quote_path(base_dir, name, path)
-    # Encode content as base64 (prevent shell injection)
-    import base64 as b64mod
-    encoded = b64mod.b64encode(content.encode('utf-8')).decode('ascii')
-    success, output = run_local_command(f"echo '{encoded}' | base64 -d > {safe}")
-    if not success:
-        return {"error": output or "Cannot save file."}
+    try:
+        with open(full, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+    except OSError as e:
+        return {"error": e.strerror or "Cannot save file."}
+    finally:
+        invalidate_file_tree(base_dir, name)
     return {"success": True, "path": path}
 
 
-def _read_file_base64(base_dir: str, name: str, path: str, require_media: bool = False):
-    """Read remote file as base64 (common internal helper).
+def _resolve_file_path(base_dir: str, name: str, path: str, require_media: bool = False):
+    """Resolve a project file path and its MIME type (common internal helper).
     If require_media=True, only allow media files.
-    Returns: (b64_data, mime, error)"""
+    Returns: (full_path, stat_result, mime, error)"""
     if not name or not path:
-        return None, None, "Project and path are required."
-    if ".." in path or path.startswith("/"):
-        return None, None, "Invalid path."
+        return None, None, None, "Project and path are required."
+    if _bad_file_path(path):
+        return None, None, None, "Invalid path."
     if require_media:
         media_type, mime = _get_media_type(path)
         if not media_type:
-            return None, None, "Not a media file."
+            return None, None, None, "Not a media file."
     else:
         ext = path.rsplit('.', 1)[-1].lower() if '.' in path else ''
         mime = MEDIA_MIME.get(ext, 'application/octet-stream')
-    safe = _shell_quote_path(base_dir, name, path)
-    success, size_out = run_local_command(f"stat -c%s {safe} 2>/dev/null")
-    if not success:
-        return None, None, "File not found."
+    full = _project_path(base_dir, name, path)
+    if full is None:
+        return None, None, None, "Invalid path."
     try:
-        if int(size_out.strip()) > 200 * 1024 * 1024:
-            return None, None, "File too large (200MB limit)."
-    except ValueError:
-        return None, None, "Cannot determine file size."
-    success, b64_out = run_local_command(f"base64 -w0 {safe}", timeout=120)
-    if not success:
-        return None, None, "Cannot read file."
-    return b64_out.strip(), mime, None
+        st = os.stat(full)
+    except OSError:
+        return None, None, None, "File not found."
+    if not stat.S_ISREG(st.st_mode):
+        return None, None, None, "File not found."
+    return full, st, mime, None
 
 
-def mode_file_raw(base_dir: str, name: str, path: str):
-    """Get media file as base64 (common for Code/Paper)"""
-    return _read_file_base64(base_dir, name, path, require_media=True)
+def _file_etag(st: os.stat_result) -> str:
+    """ETag from mtime/size (same scheme as Starlette's FileResponse)"""
+    etag_base = f"{st.st_mtime}-{st.st_size}"
+    return f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
 
 
-def mode_file_download(base_dir: str, name: str, path: str):
-    """Get file as base64 for download (all file types, common for Code/Paper)"""
-    return _read_file_base64(base_dir, name, path, require_media=False)
+def _make_file_response(base_dir: str, name: str, path: str, require_media: bool,
+                        if_none_match: str = None, headers: dict = None):
+    """Stream a project file with FileResponse (sendfile), answering 304 on a matching ETag"""
+    from fastapi.responses import FileResponse, JSONResponse, Response
+    full, st, mime, error = _resolve_file_path(base_dir, name, path, require_media)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    etag = _file_etag(st)
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    # Reuse the stat result (no second stat); FileResponse serves via sendfile and handles Range (206)
+    return FileResponse(full, media_type=mime, stat_result=st, headers={"ETag": etag, **(headers or {})})
 
 
-def make_file_raw_response(base_dir: str, name: str, path: str):
+def make_file_raw_response(base_dir: str, name: str, path: str, if_none_match: str = None):
     """Generate HTTP response for media file (common for Code/Paper)"""
-    from fastapi.responses import JSONResponse, Response
-    b64_data, mime, error = mode_file_raw(base_dir, name, path)
-    if error:
-        return JSONResponse({"error": error}, status_code=400)
-    return Response(content=base64.b64decode(b64_data), media_type=mime)
+    return _make_file_response(base_dir, name, path, True, if_none_match,
+                               {"Cache-Control": "no-cache"})
 
 
-def make_file_download_response(base_dir: str, name: str, path: str):
+def make_file_download_response(base_dir: str, name: str, path: str, if_none_match: str = None):
     """Generate HTTP response for file download (common for Code/Paper)"""
-    from fastapi.responses import JSONResponse, Response
-    b64_data, mime, error = mode_file_download(base_dir, name, path)
-    if error:
-        return JSONResponse({"error": error}, status_code=400)
     filename = path.split('/')[-1] if '/' in path else path
     encoded = quote(filename)
-    return Response(
-        content=base64.b64decode(b64_data), media_type=mime,
-        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{encoded}"})
+    return _make_file_response(base_dir, name, path, False, if_none_match,
+                               {"Content-Disposition": f"attachment; filename*=UTF-8''{encoded}"})
 
 
-def mode_delete_file(base_dir: str, name: str, path: str, name_pattern: str = r'^[a-zA-Z0-9_-]+$'):
-    """Delete file (common for Code/Paper)"""
+def mode_delete_file(base_dir: str, name: str, path: str, name_pattern: re.Pattern | None = PROJECT_NAME_RE):
+    """Delete file (common for Code/Paper).
+    name_pattern=None skips the name rule (caller checked it); _project_path still refuses traversal"""
     if not name or not path:
         return {"error": "Project and file path are required."}, 400
     if ".." in path or path.startswith("/"):
         return {"error": "Invalid file path."}, 400
-    if not re.match(name_pattern, name):
+    if name_pattern is not None and not name_pattern.match(name):
         return {"error": "Invalid name."}, 400
-    safe = _shell_quote_path(base_dir, name, path)
-    success, output = run_local_command(f"rm -rf {safe}")
-    if not success:
-        return {"error": f"File deletion failed: {output}"}, 500
+    full = _project_path(base_dir, name, path)
+    if full is None:
+        return {"error": "Invalid file path."}, 400
+    try:
+        # Like rm -rf: directories recursively, links/files directly, missing paths are fine
+        if os.path.isdir(full) and not os.path.islink(full):
+            shutil.rmtree(full)
+        else:
+            os.remove(full)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return {"error": f"File deletion failed: {e.strerror or e}"}, 500
+    finally:
+        invalidate_file_tree(base_dir, name)
     return {"success": True, "message": f"'{path}' has been deleted."}, 200
 
 
-def mode_create_file(base_dir: str, name: str, path: str, filename: str, name_pattern: str = r'^[a-zA-Z0-9_-]+$'):
+def mode_create_file(base_dir: str, name: str, path: str, filename: str, name_pattern: re.Pattern | None = PROJECT_NAME_RE):
     """Create file (common for Code/Paper)"""
     if not name or not filename:
         return {"error": "Project and filename are required."}, 400
     if ".." in path or (path.startswith("/") and path != "/") or ".." in filename or "/" in filename:
         return {"error": "Invalid path."}, 400
-    if not re.match(name_pattern, name):
+    if name_pattern is not None and not name_pattern.match(name):
         return {"error": "Invalid name."}, 400
     # If path is "/" then root, otherwise subdirectory path (remove trailing slash)
     clean_path = path.rstrip('/')
     rel = filename if (not clean_path or clean_path == '') else f"{clean_path}/{filename}"
-    safe = _shell_quote_path(base_dir, name, rel)
     # Create parent directory then create file
-    parent = '/'.join(rel.split('/')[:-1])
-    if parent:
-        parent_safe = _shell_quote_path(base_dir, name, parent)
-        run_local_command(f"mkdir -p {parent_safe}")
-    success, output = run_local_command(f"touch {safe}")
-    if not success:
-        return {"error": f"File creation failed: {output}"}, 500
+    parent = rel.rpartition('/')[0]
+    full = _project_path(base_dir, name, rel)
+    parent_full = _project_path(base_dir, name, parent) if parent else None
+    if full is None or (parent and parent_full is None):
+        return {"error": "Invalid path."}, 400
+    try:
+        if parent:
+            os.makedirs(parent_full, exist_ok=True)
+        # Like touch: create if missing, otherwise just bump the mtime
+        with open(full, "a"):
+            pass
+        os.utime(full)
+    except OSError as e:
+        return {"error": f"File creation failed: {e.strerror or e}"}, 500
+    finally:
+        invalidate_file_tree(base_dir, name)
     return {"success": True, "message": f"'{rel}' has been created."}, 200
 
 
-def mode_create_folder(base_dir: str, name: str, path: str, foldername: str, name_pattern: str = r'^[a-zA-Z0-9_-]+$'):
+def mode_create_folder(base_dir: str, name: str, path: str, foldername: str, name_pattern: re.Pattern | None = PROJECT_NAME_RE):
     """Create folder (common for Code/Paper)"""
     if not name or not foldername:
         return {"error": "Project and folder name are required."}, 400
     if ".." in path or (path.startswith("/") and path != "/") or ".." in foldername or "/" in foldername:
         return {"error": "Invalid path."}, 400
-    if not re.match(name_pattern, name):
+    if name_pattern is not None and not name_pattern.match(name):
         return {"error": "Invalid name."}, 400
     clean_path = path.rstrip('/')
     rel = foldername if (not clean_path or clean_path == '') else f"{clean_path}/{foldername}"
-    safe = _shell_quote_path(base_dir, name, rel)
-    success, output = run_local_command(f"mkdir -p {safe}")
-    if not success:
-        return {"error": f"Folder creation failed: {output}"}, 500
+    full = _project_path(base_dir, name, rel)
+    if full is None:
+        return {"error": "Invalid path."}, 400
+    try:
+        os.makedirs(full, exist_ok=True)
+    except OSError as e:
+        return {"error": f"Folder creation failed: {e.strerror or e}"}, 500
+    finally:
+        invalidate_file_tree(base_dir, name)
     return {"success": True, "message": f"'{rel}' has been created."}, 200
 
 
-def mode_list_directories(base_dir: str, name: str, find_extra: str = ""):
+def walk_project_tree(root: str, prune: frozenset = frozenset(), max_depth: int = 4):
+    """Walk a project directory in-process (like find -maxdepth, without following symlinks).
+    Hidden entries and directories named in prune are skipped entirely.
+    Returns: (dirs, files) as sorted relative paths"""
+    dirs, files = [], []
+    stack = [(root, "", 1)]
+    while stack:
+        path, rel_prefix, depth = stack.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
+                rel = rel_prefix + name
+                if entry.is_dir(follow_symlinks=False):
+                    if name in prune:
+                        continue
+                    dirs.append(rel)
+                    if depth < max_depth:
+                        stack.append((entry.path, rel + '/', depth + 1))
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(rel)
+    dirs.sort()
+    files.sort()
+    return dirs, files
+
+
+def mode_list_directories(base_dir: str, name: str, prune: frozenset = frozenset()):
     """List directories in project (for selecting creation location)"""
-    if not name:
+    root = _project_path(base_dir, name)
+    if root is None:
         return ["/"]
-    cmd = f"cd {base_dir}/{name} && find . -maxdepth 4 {find_extra}-type d -print | grep -v '/\\.' | sort"
-    success, output = run_local_command(cmd)
-    dirs = ["/"]
-    if success and output.strip():
-        for line in output.split('\n'):
-            line = line.strip()
-            if not line or line == '.':
-                continue
-            path = line[2:] if line.startswith('./') else line
-            if path:
-                dirs.append(path + '/')
-    return dirs
-
-
-def render_file_tree_html(base_dir: str, name: str, mode: str, find_extra: str = "",
+    try:
+        dir_paths, _ = walk_project_tree(root, prune)
+    except OSError:
+        return ["/"]
+    return ["/"] + [d + '/' for d in dir_paths]
+
+
+# File tree icon colors by extension (used when a mode passes no ext_colors)
+DEFAULT_EXT_COLORS = {'py': 'text-yellow-600', 'js': 'text-yellow-500', 'ts': 'text-blue-500',
+                      'html': 'text-orange-500', 'css': 'text-blue-400', 'json': 'text-green-500',
+                      'md': 'text-gray-500', 'tex': 'text-green-600'}
+
+# Rendered file trees: {(base_dir, name, mode): (expire_ts, root_mtime_ns, html, etag)}
+TREE_CACHE_TTL = 2.0
+TREE_CACHE_MAX_ENTRIES = 64
+_tree_cache = OrderedDict()
+# Read/evict/insert happen in asyncio.to_thread workers
+_tree_cache_lock = threading.Lock()
+
+
+def invalidate_file_tree(base_dir: str, name: str):
+    """Drop cached file tree HTML for a project (all modes)"""
+    with _tree_cache_lock:
+        for key in [k for k in _tree_cache if k[0] == base_dir and k[1] == name]:
+            del _tree_cache[key]
+
+
+def render_file_tree_html(base_dir: str, name: str, mode: str, prune: frozenset = frozenset(),
                           ext_colors: dict = None):
-    """Generate file tree HTML (common for Code/Paper)
+    """Generate file tree HTML (common for Code/Paper), cached briefly per project
     mode: 'code' or 'paper' (determines JS handler names)
-    find_extra: prune options to add to find command
+    prune: directory names to skip while walking
     ext_colors: color mapping by file extension"""
-    if not name:
-        return '<div class="text-claude-text-secondary text-xs">Select a project</div>'
+    return _file_tree_entry(base_dir, name, mode, prune, ext_colors)[0]
 
-    # Get all directories, limit files to 1000
-    dir_cmd = f"cd {base_dir}/{name} && find . -maxdepth 4 {find_extra}-type d -print | grep -v '^\\.$' | grep -v '/\\.' | sort"
-    file_cmd = f"cd {base_dir}/{name} && find . -maxdepth 4 {find_extra}-type f -print | grep -v '/\\.' | sort | head -1000"
-    success_d, output_d = run_local_command(dir_cmd)
-    success_f, output_f = run_local_command(file_cmd)
 
-    if not success_d or not success_f:
-        return f'<div class="text-red-500 text-xs">Error: {output_d if not success_d else output_f}</div>'
+def make_file_tree_response(base_dir: str, name: str, mode: str, prune: frozenset = frozenset(),
+                            ext_colors: dict = None, if_none_match: str = None):
+    """File tree as an HTMLResponse with a weak ETag (304 when the client's copy is current)"""
+    from fastapi.responses import HTMLResponse, Response
+    html, etag = _file_tree_entry(base_dir, name, mode, prune, ext_colors)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
 
-    dir_lines = [l.strip() for l in output_d.split('\n') if l.strip()] if output_d.strip() else []
-    file_lines = [l.strip() for l in output_f.split('\n') if l.strip()] if output_f.strip() else []
+
+def _file_tree_entry(base_dir: str, name: str, mode: str, prune: frozenset, ext_colors: dict):
+    """Cached (html, etag) for a project's file tree"""
+    if not name:
+        return '<div class="text-claude-text-secondary text-xs">Select a project</div>', 'W/"empty"'
+    root = _project_path(base_dir, name)
+    if root is None:
+        return '<div class="text-red-500 text-xs">Invalid project</div>', 'W/"invalid"'
+    key = (base_dir, name, mode)
+    try:
+        root_mtime = os.stat(root).st_mtime_ns
+    except OSError:
+        root_mtime = None
+    now = time.monotonic()
+    with _tree_cache_lock:
+        cached = _tree_cache.get(key)
+    if cached and cached[0] > now and cached[1] == root_mtime:
+        return cached[2], cached[3]
+    html = _render_file_tree_html(root, mode, prune, ext_colors)
+    # Content hash, so a re-render after TTL expiry still matches if nothing changed
+    etag = f'W/"{hashlib.blake2b(html.encode(), digest_size=8).hexdigest()}"'
+    with _tree_cache_lock:
+        _tree_cache.pop(key, None)
+        if len(_tree_cache) >= TREE_CACHE_MAX_ENTRIES:
+            # Evict the least recently rendered project (checked and popped under the same lock)
+            _tree_cache.popitem(last=False)
+        _tree_cache[key] = (now + TREE_CACHE_TTL, root_mtime, html, etag)
+    return html, etag
+
+
+def _render_file_tree_html(root: str, mode: str, prune: frozenset, ext_colors: dict):
+    """Walk the project and build the file tree HTML"""
+    # Get all directories, limit files to 1000
+    try:
+        dir_lines, file_lines = walk_project_tree(root, prune)
+    except OSError as e:
+        return f'<div class="text-red-500 text-xs">Error: {html_lib.escape(str(e))}</div>'
     file_truncated = len(file_lines) >= 1000
+    file_lines = file_lines[:1000]
 
     if not dir_lines and not file_lines:
         return '<div class="text-claude-text-secondary text-xs py-4 text-center">Empty project</div>'
@@ -1088,28 +1528,17 @@ def render_file_tree_html(base_dir: str, name: str, mode: str, find_extra: str =
     delete_fn = f"_deleteFile('{mode}', "
 
     if ext_colors is None:
-        ext_colors = {'py': 'text-yellow-600', 'js': 'text-yellow-500', 'ts': 'text-blue-500',
-                      'html': 'text-orange-500', 'css': 'text-blue-400', 'json': 'text-green-500',
-                      'md': 'text-gray-500', 'tex': 'text-green-600'}
+        ext_colors = DEFAULT_EXT_COLORS
 
-    dirs_with_children = set()
-    for line in lines:
-        path = line[2:] if line.startswith('./') else line
-        if '/' in path:
-            dirs_with_children.add('/'.join(path.split('/')[:-1]))
+    dirs_with_children = {path.rpartition('/')[0] for path in lines if '/' in path}
 
-    html = '<div class="space-y-0.5 file-tree-container">'
-
-    for line in lines:
-        path = line[2:] if line.startswith('./') else line
-        if not path:
-            continue
+    parts = ['<div class="space-y-0.5 file-tree-container">']
 
+    for path in lines:
         depth = path.count('/')
         indent = depth * 12
-        file_name = path.split('/')[-1]
-        parent_path = '/'.join(path.split('/')[:-1]) if '/' in path else ''
-        is_dir = line in dir_set
+        parent_path, _, file_name = path.rpartition('/')
+        is_dir = path in dir_set
         escaped_path = path.replace("'", "\\'")
         escaped_path_attr = html_lib.escape(path, quote=True)
         escaped_parent_attr = html_lib.escape(parent_path, quote=True) if parent_path else ''
@@ -1130,7 +1559,7 @@ def render_file_tree_html(base_dir: str, name: str, mode: str, find_extra: str =
                     <path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M9 5l7 7-7 7"/>
                 </svg>''' if has_children else '<span class="w-3"></span>'
 
-            html += f'''
+            parts.append(f'''
             <div class="group flex items-center gap-1 py-0.5 hover:bg-claude-border rounded px-1 {hidden_class}"
                  data-path="{escaped_path_attr}" {parent_attr} style="padding-left: {indent}px"
                  @click="toggleFolder('{escaped_path}', '{mode}')"
@@ -1143,12 +1572,12 @@ def render_file_tree_html(base_dir: str, name: str, mode: str, find_extra: str =
                 <span class="truncate text-claude-text flex-1">{html_lib.escape(file_name)}</span>
                 {more_btn}
             </div>
-            '''
+            ''')
         else:
-            ext = file_name.split('.')[-1].lower()
+            ext = file_name.rpartition('.')[2].lower()
             color = ext_colors.get(ext, 'text-gray-400')
 
-            html += f'''
+            parts.append(f'''
             <div @click="{open_fn}'{escaped_path}')" class="group flex items-center gap-1 py-0.5 hover:bg-claude-border rounded px-1 cursor-pointer {hidden_class}"
                  data-path="{escaped_path_attr}" {parent_attr} style="padding-left: {indent + 12}px"
                  @touchstart="startLongPress($event, 'file', {{mode: '{mode}', path: '{escaped_path}', name: '{escaped_name_attr}'}})"
@@ -1159,19 +1588,33 @@ def render_file_tree_html(base_dir: str, name: str, mode: str, find_extra: str =
                 <span class="truncate text-claude-text flex-1">{html_lib.escape(file_name)}</span>
                 {more_btn}
             </div>
-            '''
+            ''')
 
     if file_truncated:
-        html += '<div class="text-claude-text-secondary text-xs py-2 px-2 text-center">Too many files, showing only 1000</div>'
+        parts.append('<div class="text-claude-text-secondary text-xs py-2 px-2 text-center">Too many files, showing only 1000</div>')
+
+    parts.append('</div>')
+    return ''.join(parts)
+
+
+# Rendered messages HTML per mode session: {(mode, name, path_prefix): (last_message_id, html)}
+_messages_html_cache = {}
+# Written from asyncio.to_thread workers (same rule as _tree_cache_lock)
+_messages_html_cache_lock = threading.Lock()
 
-    html += '</div>'
-    return html
+
+def _invalidate_messages_html(mode: str, name: str):
+    """Drop cached messages HTML for a mode session"""
+    with _messages_html_cache_lock:
+        for key in [k for k in _messages_html_cache if k[0] == mode and k[1] == name]:
+            del _messages_html_cache[key]
 
 
 def mode_clear_session(mode: str, name: str, param_label: str):
     """Common session reset handler (Code/Paper)"""
     if name:
         db.clear_mode_session(mode, name)
+        _invalidate_messages_html(mode, name)
         new_cli_session_id = str(uuid.uuid4())
         db.set_setting(f"cli_session_{mode}_{name}", new_cli_session_id)
         return {"success": True, "session_id": f"{mode}_{name}"}
@@ -1189,14 +1632,24 @@ def mode_messages_html(mode: str, name: str, path_prefix: str):
     """Common handler for returning messages HTML"""
     if not name:
         return ""
-    messages = db.get_mode_messages(mode, name)
-    return render_mode_messages_html(
-        messages, f"{path_prefix}/{html_lib.escape(name)}"
+    # Messages are append-only, so the newest id identifies the rendered state
+    # (get_mode_state never keeps a snapshot older than the last message write)
+    key = (mode, name, path_prefix)
+    last_id = db.get_mode_last_message_id(mode, name)
+    with _messages_html_cache_lock:
+        cached = _messages_html_cache.get(key)
+    if cached and cached[0] == last_id:
+        return cached[1]
+    html = render_mode_messages_html(
+        db.iter_mode_messages(mode, name), f"{path_prefix}/{html_lib.escape(name)}"
     )
+    with _messages_html_cache_lock:
+        _messages_html_cache[key] = (last_id, html)
+    return html
 
 
-def render_mode_messages_html(messages: list, path_label: str):
-    """Render Code/Paper mode messages as HTML"""
+def render_mode_messages_html(messages, path_label: str):
+    """Render Code/Paper mode messages as HTML (messages: any iterable of rows)"""
     connection_html = f"""
     <div class="bg-claude-accent/5 border border-claude-accent/20 rounded-lg p-4 flex items-center gap-3 mb-4">
         <div class="w-3 h-3 bg-claude-accent rounded-full animate-pulse"></div>
@@ -1207,34 +1660,26 @@ def render_mode_messages_html(messages: list, path_label: str):
     </div>
     """
 
-    if not messages:
-        return connection_html
-
-    html = connection_html
+    parts = [connection_html]
     for msg in messages:
         if msg["role"] == "user":
-            html += render_user_message_html(msg["content"], include_script=False)
+            parts.append(render_user_message_html(msg["content"], include_script=False))
         else:
-            events = []
-            if msg.get("reasoning"):
-                try:
-                    events = json.loads(msg["reasoning"])
-                except (json.JSONDecodeError, ValueError):
-                    pass
+            events = msg.get("reasoning") or []
             events_html = render_tool_events_html(events)
             has_text_events = any(evt.get("type") == "text" for evt in events)
             if msg["content"] and not has_text_events:
-                html += f'<div class="mb-4 space-y-2">{events_html}<div class="bg-white border border-claude-border rounded-lg p-4 text-claude-text text-sm"><div class="markdown-body" data-raw="{html_lib.escape(msg["content"])}">{html_lib.escape(msg["content"])}</div></div></div>'
+                parts.append(f'<div class="mb-4 space-y-2">{events_html}<div class="bg-white border border-claude-border rounded-lg p-4 text-claude-text text-sm"><div class="markdown-body" data-raw="{html_lib.escape(msg["content"])}">{html_lib.escape(msg["content"])}</div></div></div>')
             elif events_html:
-                html += f'<div class="mb-4 space-y-2">{events_html}</div>'
+                parts.append(f'<div class="mb-4 space-y-2">{events_html}</div>')
 
-    return html
+    return "".join(parts)
 
 
-def mode_chat_handler(mode: str, name: str, message: str, mcp_tools: str, file_map: str,
-                      work_dir: str, responses: dict, streams: dict, get_session_lock,
-                      label: str, status_text: str, model: str = "sonnet"):
-    """Common chat handler for Code/Paper mode: preprocess message -> start thread -> return HTML"""
+async def mode_chat_handler(mode: str, name: str, message: str, mcp_tools: str, file_map: str,
+                            work_dir: str, responses: dict, streams: dict, get_session_lock,
+                            label: str, status_text: str, model: str = "sonnet"):
+    """Common chat handler for Code/Paper mode: preprocess message -> start task -> return HTML"""
     if not name or not message:
         return f'<div class="text-red-500">{label} is required.</div>'
 
@@ -1243,34 +1688,32 @@ def mode_chat_handler(mode: str, name: str, message: str, mcp_tools: str, file_m
     if model not in allowed_models:
         model = "sonnet"
 
-    cleanup_old_responses(responses)
-    message = replace_command_placeholders(message)
-    fmap = parse_file_map(file_map)
+    def prepare():
+        cleanup_old_responses(responses)
+        msg = replace_command_placeholders(message)
+        fmap = parse_file_map(file_map)
+        db.add_mode_message(mode, name, "user", msg)
+        cli_msg = replace_file_placeholders(msg, fmap) if fmap else msg
+        _, is_first, cli_sid = get_or_create_mode_session(mode, name, lambda p: db.get_mode_messages(mode, p))
+        return msg, cli_msg, is_first, cli_sid
 
-    db.add_mode_message(mode, name, "user", message)
-    cli_message = replace_file_placeholders(message, fmap) if fmap else message
-
-    _, is_first_message, cli_session_id = get_or_create_mode_session(mode, name, lambda p: db.get_mode_messages(mode, p))
+    message, cli_message, is_first_message, cli_session_id = await asyncio.to_thread(prepare)
     response_id = str(uuid.uuid4())[:8]
 
     item_key = "paper" if mode == "paper" else "project"
     responses[response_id] = {
-        item_key: name, "status": "pending", "events": [], "final_result": "",
+        item_key: name, "status": "pending", "events": EventLog(keep=MODE_PERSIST_EVENTS), "final_result": "",
         "context_percent": 0, "error": None, "cancelled": False, "created_at": time.time()
     }
     streams[response_id] = {"cancelled": False, "process": None}
 
-    mode_opts = {"event_filter": {"text", "tool_use", "edit_result", "bash_result"}}
-    thread = threading.Thread(
-        target=run_mode_generation,
-        args=(response_id, mode, name, cli_message, is_first_message, cli_session_id, mcp_tools,
-              work_dir, responses, streams, get_session_lock,
-              lambda n, pct: db.update_mode_context_percent(mode, n, pct),
-              lambda n, role, content, events=None: db.add_mode_message(mode, n, role, content, events),
-              model, mode_opts)
-    )
-    thread.daemon = True
-    thread.start()
+    start_background_task(run_mode_generation(
+        response_id, mode, name, cli_message, is_first_message, cli_session_id, mcp_tools,
+        work_dir, responses, streams, get_session_lock,
+        lambda n, pct: db.update_mode_context_percent(mode, n, pct),
+        lambda n, role, content, events=None: db.add_mode_message(mode, n, role, content, events),
+        model
+    ))
 
     escaped_name = html_lib.escape(name)
     return f"""
@@ -1298,11 +1741,9 @@ def generate_session_title(user_message: str) -> str:
     fallback = user_message[:12] + "..." if len(user_message) > 12 else user_message
     try:
         prompt = f"Create a short 2-4 word English title for the following question. Output only the title.\n\nQuestion: {user_message[:200]}\n\nTitle:"
-        escaped_prompt = prompt.replace("'", "'\"'\"'")
-        cli_cmd = f"echo '{escaped_prompt}' | claude -p --model haiku --output-format stream-json --verbose --max-turns 1"
         result = subprocess.run(
-            ["bash", "-c", cli_cmd],
-            capture_output=True, text=True, timeout=10
+            ["claude", "-p", "--model", "haiku", "--output-format", "stream-json", "--verbose", "--max-turns", "1"],
+            input=prompt + "\n", capture_output=True, text=True, timeout=10
         )
         if result.returncode == 0:
             for line in result.stdout.strip().split('\n'):
@@ -1320,27 +1761,28 @@ def generate_session_title(user_message: str) -> str:
     return fallback
 
 
-def chat_handler(session_id: str, message: str, mcp_tools: str, file_map: str,
-                 chat_dir: str, system_prompt: str, responses: dict, streams: dict,
-                 get_session_lock, model: str = "sonnet"):
-    """Chat mode handler: preprocess -> start thread -> return (response_id, session_id, message)"""
+async def chat_handler(session_id: str, message: str, mcp_tools: str, file_map: str,
+                       chat_dir: str, system_prompt: str, responses: dict, streams: dict,
+                       get_session_lock, model: str = "sonnet"):
+    """Chat mode handler: preprocess -> start task -> return (response_id, session_id, message)"""
     allowed_models = ("haiku", "sonnet", "opus")
     if model not in allowed_models:
         model = "sonnet"
 
-    cleanup_old_responses(responses)
-    message = replace_command_placeholders(message)
-    fmap = parse_file_map(file_map)
-
-    if not session_id:
-        session_id = str(uuid.uuid4())
-        db.create_session(session_id, mode="chat")
-    elif not db.get_session(session_id):
-        db.create_session(session_id, mode="chat")
-
-    db.add_message(session_id, "user", message)
-    cli_message = replace_file_placeholders(message, fmap) if fmap else message
-    is_first_message = db.count_user_messages(session_id) == 1
+    def prepare(sid):
+        cleanup_old_responses(responses)
+        msg = replace_command_placeholders(message)
+        fmap = parse_file_map(file_map)
+        if not sid:
+            sid = str(uuid.uuid4())
+            db.create_session(sid, mode="chat")
+        elif not db.session_exists(sid):
+            db.create_session(sid, mode="chat")
+        db.add_message(sid, "user", msg)
+        cli_msg = replace_file_placeholders(msg, fmap) if fmap else msg
+        return sid, msg, cli_msg, db.count_user_messages(sid) == 1
+
+    session_id, message, cli_message, is_first_message = await asyncio.to_thread(prepare, session_id)
 
     response_id = str(uuid.uuid4())[:8]
     responses[response_id] = {
@@ -1352,23 +1794,24 @@ def chat_handler(session_id: str, message: str, mcp_tools: str, file_map: str,
         "error": None,
         "cancelled": False,
         "created_at": time.time(),
-        "events": []
+        "events": EventLog()
     }
     streams[response_id] = {"cancelled": False, "process": None}
 
-    escaped_prompt = system_prompt.replace("'", "'\"'\"'")
-    extra_cli_flags = f"--system-prompt '{escaped_prompt}' --tools 'WebSearch,Read'"
+    extra_cli_flags = ["--system-prompt", system_prompt, "--tools", "WebSearch,Read"]
+
+    loop = asyncio.get_running_loop()
 
     def on_first(rid, msg):
         def _gen_title():
             title = generate_session_title(msg)
             db.update_session_title(session_id, title)
             responses[rid]["title"] = title
+            loop.call_soon_threadsafe(responses[rid]["events"].notify)
         threading.Thread(target=_gen_title, daemon=True).start()
 
     def add_msg_fn(_name, role, content, events=None):
-        events_json = json.dumps(events) if events else None
-        msg_id = db.add_message(session_id, role, content, reasoning=events_json)
+        msg_id = db.add_message(session_id, role, content, reasoning=events)
         responses[response_id]["message_id"] = msg_id
 
     def update_ctx_fn(_name, pct):
@@ -1384,17 +1827,13 @@ def chat_handler(session_id: str, message: str, mcp_tools: str, file_map: str,
         "on_first_message": on_first,
         "work_dir_suffix": "",
         "on_text": on_text,
-        "event_filter": None,
     }
 
-    thread = threading.Thread(
-        target=run_mode_generation,
-        args=(response_id, "chat", session_id, cli_message, is_first_message,
-              session_id, mcp_tools, chat_dir, responses, streams,
-              get_session_lock, update_ctx_fn, add_msg_fn, model, mode_opts)
-    )
-    thread.daemon = True
-    thread.start()
+    start_background_task(run_mode_generation(
+        response_id, "chat", session_id, cli_message, is_first_message,
+        session_id, mcp_tools, chat_dir, responses, streams,
+        get_session_lock, update_ctx_fn, add_msg_fn, model, mode_opts
+    ))
 
     return response_id, session_id, message
 
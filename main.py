@@ -5,7 +5,7 @@ Ddoli - Claude Clone main server
 """
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Form, File, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import asyncio
@@ -15,10 +15,11 @@ import uuid
 import html as html_lib
 import json
 import os
+import weakref
 
 from app import db
 from app.config import CHAT_DIR, CHAT_SYSTEM_PROMPT
-from app.shared import render_user_message_html, render_tool_events_html, MCP_SERVERS, init_mcp_servers, UPLOAD_DIR, add_mcp_server, update_mcp_server, remove_mcp_server, chat_handler, make_chat_extra_events_fn, mode_stream_sse, mode_status_response, mode_active_response
+from app.shared import render_user_message_html, render_tool_events_html, MCP_SERVERS, init_mcp_servers, UPLOAD_DIR, add_mcp_server, update_mcp_server, remove_mcp_server, refresh_mcp_server, chat_handler, make_chat_extra_events_fn, mode_stream_sse, mode_status_response, mode_active_response, PROJECT_NAME_RE, BoundedResponses
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -31,6 +32,7 @@ def ensure_chat_directory():
 @asynccontextmanager
 async def lifespan(app):
     ensure_chat_directory()
+    paper_routes.ensure_paper_directories()
     threading.Thread(target=init_mcp_servers, daemon=True).start()
     yield
 
@@ -40,19 +42,19 @@ app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
 
-# Per-session lock (prevent concurrent messages)
-_session_locks: dict[str, threading.Lock] = {}
-_session_locks_guard = threading.Lock()
+# Per-session lock (prevent concurrent messages); dropped once no generation holds or awaits it
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
 
-def get_session_lock(session_key: str) -> threading.Lock:
-    """Return per-session lock (create if not exists)"""
-    with _session_locks_guard:
-        if session_key not in _session_locks:
-            _session_locks[session_key] = threading.Lock()
-        return _session_locks[session_key]
+def get_session_lock(session_key: str) -> asyncio.Lock:
+    """Return per-session lock (create if not exists, event loop only)"""
+    lock = _session_locks.get(session_key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _session_locks[session_key] = lock
+    return lock
 
 # Active response status tracking (managed by chat_handler)
-active_responses = {}
+active_responses = BoundedResponses()
 
 # Chat streaming tracking
 chat_streams = {}  # {response_id: {"cancelled": bool, "process": ...}}
@@ -92,7 +94,7 @@ app.include_router(terminal_router)
 @app.get("/settings/model")
 async def get_selected_model():
     """Return saved model setting"""
-    model = db.get_setting("selected_model") or "sonnet"
+    model = await asyncio.to_thread(db.get_setting, "selected_model") or "sonnet"
     return JSONResponse({"model": model})
 
 
@@ -103,7 +105,7 @@ async def save_selected_model(request: Request):
     model = data.get("model", "sonnet")
     if model not in ("haiku", "sonnet", "opus"):
         model = "sonnet"
-    db.set_setting("selected_model", model)
+    await asyncio.to_thread(db.set_setting, "selected_model", model)
     return JSONResponse({"success": True})
 
 
@@ -127,7 +129,7 @@ async def get_mcp_tools(mode: str = ""):
 @app.get("/mcp/settings")
 async def get_mcp_settings():
     """Return saved MCP tool enabled list"""
-    raw = db.get_setting("enabled_mcp_tools")
+    raw = await asyncio.to_thread(db.get_setting, "enabled_mcp_tools")
     if raw:
         try:
             return JSONResponse(json.loads(raw))
@@ -140,7 +142,7 @@ async def get_mcp_settings():
 async def save_mcp_settings(request: Request):
     """Save MCP tool enabled list"""
     tools = await request.json()
-    db.set_setting("enabled_mcp_tools", json.dumps(tools))
+    await asyncio.to_thread(db.set_setting, "enabled_mcp_tools", json.dumps(tools))
     return JSONResponse({"success": True})
 
 
@@ -187,7 +189,7 @@ async def create_mcp_server(request: Request):
     """Add MCP server"""
     data = await request.json()
     name = data.get("name", "").strip()
-    if not name or not re.match(r'^[a-zA-Z0-9_-]+$', name):
+    if not name or not PROJECT_NAME_RE.match(name):
         return JSONResponse({"success": False, "error": "Name can only contain letters, numbers, _, and -."}, status_code=400)
     server_config, error = _build_mcp_server_config(data)
     if error:
@@ -211,10 +213,19 @@ async def edit_mcp_server(key: str, request: Request):
     return JSONResponse({"success": True, "message": message})
 
 
+@app.post("/mcp/servers/{key}/refresh")
+async def refresh_mcp_server_tools(key: str):
+    """Rediscover an MCP server's tools (ignores the tool cache)"""
+    success, message = await asyncio.to_thread(refresh_mcp_server, key)
+    if not success:
+        return JSONResponse({"success": False, "error": message}, status_code=404)
+    return JSONResponse({"success": True, "message": message})
+
+
 @app.delete("/mcp/servers/{key}")
 async def delete_mcp_server(key: str):
     """Delete MCP server"""
-    success, message = remove_mcp_server(key)
+    success, message = await asyncio.to_thread(remove_mcp_server, key)
     if not success:
         return JSONResponse({"success": False, "error": message}, status_code=404)
     return JSONResponse({"success": True, "message": message})
@@ -255,7 +266,7 @@ async def home(request: Request):
 @app.post("/chat", response_class=HTMLResponse)
 async def chat(message: str = Form(""), session_id: str = Form(""), mcp_tools: str = Form(""), file_map: str = Form(""), model: str = Form("sonnet")):
     """Send chat message"""
-    response_id, session_id, message = chat_handler(
+    response_id, session_id, message = await chat_handler(
         session_id, message, mcp_tools, file_map,
         CHAT_DIR, CHAT_SYSTEM_PROMPT,
         active_responses, chat_streams, get_session_lock, model
@@ -266,7 +277,7 @@ async def chat(message: str = Form(""), session_id: str = Form(""), mcp_tools: s
 @app.get("/chat/status/{response_id}")
 async def get_chat_status(response_id: str):
     """Query active chat response status"""
-    return JSONResponse(mode_status_response(
+    return ORJSONResponse(mode_status_response(
         response_id, active_responses, "session_id",
         extra_fields_fn=lambda resp: {
             "content": resp.get("content", ""),
@@ -279,16 +290,17 @@ async def get_chat_status(response_id: str):
 @app.get("/chat/active")
 async def get_active_chats(session_id: str = ""):
     """Query active response ID list for session"""
-    return JSONResponse(mode_active_response(active_responses, "session_id", session_id))
+    return ORJSONResponse(mode_active_response(active_responses, "session_id", session_id))
 
 
 @app.get("/stream")
-async def stream(id: str = "", start_from: int = 0):
+async def stream(request: Request, id: str = "", start_from: int = 0):
     """Stream AI response via SSE"""
     return await mode_stream_sse(
         id, active_responses, chat_streams, start_from,
         extra_events_fn=make_chat_extra_events_fn(),
-        done_data_fn=lambda resp: str(resp.get("message_id", "")) if resp.get("message_id") else ""
+        done_data_fn=lambda resp: str(resp.get("message_id", "")) if resp.get("message_id") else "",
+        request=request
     )
 
 
@@ -306,6 +318,7 @@ def _cancel_streams(streams: dict, responses: dict, active_statuses: tuple) -> i
     for info in list(responses.values()):
         if info.get("status") in active_statuses:
             info["cancelled"] = True
+            info["events"].notify()
             cancelled += 1
     return cancelled
 
@@ -328,20 +341,20 @@ async def stop_stream(mode: str = Form("chat")):
 async def clear_history(session_id: str = Form("")):
     """Clear conversation history"""
     if session_id:
-        db.delete_session(session_id)
+        await asyncio.to_thread(db.delete_session, session_id)
     return HTMLResponse('<script>document.getElementById("session-title").textContent = "New Chat";</script>')
 
 
 @app.get("/sessions")
 async def get_sessions(mode: str = "chat"):
     """Query session list"""
-    return JSONResponse(db.get_sessions_by_mode(mode))
+    return ORJSONResponse(await asyncio.to_thread(db.get_sessions_by_mode, mode))
 
 
 @app.delete("/sessions/{mode}")
 async def delete_all_sessions(mode: str):
     """Delete all sessions by mode"""
-    db.delete_all_sessions_by_mode(mode)
+    await asyncio.to_thread(db.delete_all_sessions_by_mode, mode)
     return JSONResponse({"success": True})
 
 
@@ -349,31 +362,30 @@ async def delete_all_sessions(mode: str):
 @app.get("/session/{session_id}/messages", response_class=HTMLResponse)
 async def get_session_messages(session_id: str):
     """Session message list HTML"""
-    if not db.get_session(session_id):
+    if not await asyncio.to_thread(db.session_exists, session_id):
         return HTMLResponse("")
+    return HTMLResponse(await asyncio.to_thread(_render_session_messages_html, session_id))
+
 
-    html = ""
-    for msg in db.get_messages(session_id):
+def _render_session_messages_html(session_id: str) -> str:
+    """Render a chat session's messages, streaming rows from the DB"""
+    parts = []
+    for msg in db.iter_messages(session_id):
         if msg["role"] == "user":
-            html += render_user_message_html(msg["content"], include_script=False)
+            parts.append(render_user_message_html(msg["content"], include_script=False))
         else:
             message_id = msg.get("id", 0)
             content = msg.get("content", "")
 
-            # Parse and render tool events
-            events = []
-            if msg.get("reasoning"):
-                try:
-                    events = json.loads(msg["reasoning"])
-                except (json.JSONDecodeError, ValueError):
-                    pass
+            # Render tool events (stored as JSONB, already decoded)
+            events = msg.get("reasoning") or []
             events_html = render_tool_events_html(events)
 
             # If events contain text, skip rendering content separately (prevent duplication)
             has_text_events = any(evt.get("type") == "text" for evt in events)
             content_html = "" if has_text_events else f'<div class="markdown-body" data-raw="{html_lib.escape(content)}"></div>'
 
-            html += f'''
+            parts.append(f'''
             <div class="mb-6" data-message-id="{message_id}">
                 <div class="text-claude-text">
                     {events_html}
@@ -385,15 +397,15 @@ async def get_session_messages(session_id: str):
                     </div>
                 </div>
             </div>
-            '''
+            ''')
 
-    return HTMLResponse(html)
+    return "".join(parts)
 
 
 @app.delete("/session/{session_id}")
 async def delete_session(session_id: str):
     """Delete session"""
-    db.delete_session(session_id)
+    await asyncio.to_thread(db.delete_session, session_id)
     return JSONResponse({"success": True})
 
 
@@ -402,7 +414,7 @@ async def toggle_archive(mode: str, name: str):
     """Toggle project/paper archive"""
     if mode not in ("code", "paper"):
         return JSONResponse({"error": "Invalid mode."}, status_code=400)
-    archived = db.archive_mode_project(mode, name)
+    archived = await asyncio.to_thread(db.archive_mode_project, mode, name)
     return JSONResponse({"success": True, "archived": archived})
 
 
@@ -411,7 +423,7 @@ async def get_archived(mode: str):
     """List archived projects/papers"""
     if mode not in ("code", "paper"):
         return JSONResponse({"error": "Invalid mode."}, status_code=400)
-    return JSONResponse(db.get_archived_projects(mode))
+    return JSONResponse(await asyncio.to_thread(db.get_archived_projects, mode))
 
 
 # ========== Commands API ==========
@@ -419,41 +431,41 @@ async def get_archived(mode: str):
 @app.get("/commands")
 async def get_commands():
     """Query command list"""
-    return JSONResponse(db.get_commands())
+    return ORJSONResponse(await asyncio.to_thread(db.get_commands))
 
 
 @app.get("/command/{command_id}")
 async def get_command(command_id: int):
     """Query command"""
-    cmd = db.get_command(command_id)
+    cmd = await asyncio.to_thread(db.get_command, command_id)
     if not cmd:
         return JSONResponse({"error": "Command not found"}, status_code=404)
-    return JSONResponse(cmd)
+    return ORJSONResponse(cmd)
 
 
 @app.get("/command/name/{name}")
 async def get_command_by_name(name: str):
     """Query command by name"""
-    cmd = db.get_command_by_name(name)
+    cmd = await asyncio.to_thread(db.get_command_by_name, name)
     if not cmd:
         return JSONResponse({"error": "Command not found"}, status_code=404)
-    return JSONResponse(cmd)
+    return ORJSONResponse(cmd)
 
 
 @app.post("/command")
 async def create_command(name: str = Form(...), content: str = Form(...)):
     """Create command"""
     # Name validation (letters, numbers, hyphens, underscores only)
-    if not re.match(r'^[a-zA-Z0-9_-]+$', name):
+    if not PROJECT_NAME_RE.match(name):
         return JSONResponse({"error": "Command name can only contain letters, numbers, hyphens, and underscores"}, status_code=400)
 
     # Duplicate check
-    if db.get_command_by_name(name):
+    if await asyncio.to_thread(db.get_command_by_name, name):
         return JSONResponse({"error": "Command name already exists"}, status_code=400)
 
     try:
-        cmd = db.create_command(name, content)
-        return JSONResponse(cmd)
+        cmd = await asyncio.to_thread(db.create_command, name, content)
+        return ORJSONResponse(cmd)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
@@ -461,16 +473,16 @@ async def create_command(name: str = Form(...), content: str = Form(...)):
 @app.put("/command/{command_id}")
 async def update_command(command_id: int, name: str = Form(None), content: str = Form(None)):
     """Update command"""
-    if name and not re.match(r'^[a-zA-Z0-9_-]+$', name):
+    if name and not PROJECT_NAME_RE.match(name):
         return JSONResponse({"error": "Command name can only contain letters, numbers, hyphens, and underscores"}, status_code=400)
 
     # Duplicate check on name change
     if name:
-        existing = db.get_command_by_name(name)
+        existing = await asyncio.to_thread(db.get_command_by_name, name)
         if existing and existing["id"] != command_id:
             return JSONResponse({"error": "Command name already exists"}, status_code=400)
 
-    if db.update_command(command_id, name, content):
+    if await asyncio.to_thread(db.update_command, command_id, name, content):
         return JSONResponse({"success": True})
     return JSONResponse({"error": "Command not found"}, status_code=404)
 
@@ -478,7 +490,7 @@ async def update_command(command_id: int, name: str = Form(None), content: str =
 @app.delete("/command/{command_id}")
 async def delete_command(command_id: int):
     """Delete command"""
-    if db.delete_command(command_id):
+    if await asyncio.to_thread(db.delete_command, command_id):
         return JSONResponse({"success": True})
     return JSONResponse({"error": "Command not found"}, status_code=404)
 
@@ -1574,7 +1574,7 @@ window.appData = function() {
             const scrollToBottom = () => { if (scrollParent) scrollParent.scrollTop = scrollParent.scrollHeight; };
             scrollToBottom();
 
-            const eventSource = new EventSource(cfg.streamUrl + responseId + '&start_from=' + (status.events?.length || 0));
+            const eventSource = new EventSource(cfg.streamUrl + responseId + '&start_from=' + (status.next_idx ?? status.events?.length ?? 0));
             window[cfg.eventSourceKey] = eventSource;
             bindToolSSEListeners(eventSource, { eventsEl, displayedToolIds, rawContent, checkIdx: isChat ? createIdxChecker() : undefined, updateStatus: updateStatusText, scrollToBottom });
             if (!isChat) eventSource.addEventListener('result', e => { try { const d = JSON.parse(e.data); if (statusEl) statusEl.remove(); if (d.contextPercent !== undefined) this[cfg.contextKey] = d.contextPercent; } catch(err) {} });